@@ -58,8 +58,42 @@ import numbers
 import numpy
 
 
+def _has_mixed_ties(predictions, actuals):
+    """Whether some equal predictions have different (positive or not) labels.
+
+    The average precision only depends on the order the pairs are given in when
+    such ties exist.
+    """
+    order = numpy.argsort(predictions, kind="stable")
+    predictions = predictions[order]
+    hits = actuals[order] > 0
+    return bool(numpy.any((predictions[1:] == predictions[:-1]) &
+                          (hits[1:] != hits[:-1])))
+
+
+def _heap_order(predictions, actuals):
+    """Reorders the pairs like the list of a heap they were pushed to in order."""
+    heap = []
+    for pair in zip(predictions.tolist(), actuals.tolist()):
+        heapq.heappush(heap, pair)
+    return (numpy.array([pair[0] for pair in heap], dtype=predictions.dtype),
+            numpy.array([pair[1] for pair in heap], dtype=actuals.dtype))
+
+
 class AveragePrecisionCalculator(object):
-    """Calculate the average precision and average precision at n."""
+    """Calculate the average precision and average precision at n.
+
+    Without a top_n, the (prediction, actual) pairs are appended to growable
+    numpy buffers in arrival order. The order only matters for predictions tied
+    with different labels, which the seeded shuffle of ap_at_n orders by their
+    position in a heap: the heap is then rebuilt from the buffers when the
+    average precision is computed. With a top_n, the pairs are kept in a heap of
+    at most top_n entries, into which only the predictions higher than its
+    minimum are pushed.
+    """
+
+    # Initial number of slots in the growable prediction/label buffers.
+    _INITIAL_CAPACITY = 1024
 
     def __init__(self, top_n=None):
         """Construct an AveragePrecisionCalculator to calculate average precision.
@@ -78,11 +112,16 @@ class AveragePrecisionCalculator(object):
 
         self._top_n = top_n  # average precision at n
         self._total_positives = 0  # total number of positives have seen
-        self._heap = []  # max heap of (prediction, actual)
+        self._heap = []  # min heap of (prediction, actual) when top_n is set
+        self._predictions = numpy.empty(0, dtype=numpy.float32)
+        self._actuals = numpy.empty(0, dtype=numpy.bool_)
+        self._size = 0  # number of valid entries in the buffers
 
     @property
     def heap_size(self):
-        """Gets the heap size maintained in the class."""
+        """Gets the number of (prediction, actual) pairs kept in the class."""
+        if self._top_n is None:
+            return self._size
         return len(self._heap)
 
     @property
@@ -116,24 +155,114 @@ class AveragePrecisionCalculator(object):
             if not isinstance(num_positives, numbers.Number) or num_positives < 0:
                 raise ValueError("'num_positives' was provided but it wan't a nonzero number.")
 
+        predictions = numpy.asarray(predictions).reshape(-1)
+        actuals = numpy.asarray(actuals).reshape(-1)
+
         if not num_positives is None:
             self._total_positives += num_positives
         else:
-            self._total_positives += numpy.size(numpy.where(actuals > 0))
-        topk = self._top_n
+            self._total_positives += int(numpy.count_nonzero(actuals > 0))
+
+        if self._top_n is None:
+            self._append(predictions, actuals)
+        elif self._top_n > 0:
+            self._push(predictions, actuals)
+
+    def _append(self, predictions, actuals):
+        """Appends a chunk to the buffers, growing them geometrically."""
+        required = self._size + predictions.size
+        prediction_dtype = numpy.promote_types(self._predictions.dtype,
+                                               predictions.dtype)
+        actual_dtype = numpy.promote_types(self._actuals.dtype, actuals.dtype)
+        if (required > self._predictions.size or
+                prediction_dtype != self._predictions.dtype or
+                actual_dtype != self._actuals.dtype):
+            capacity = max(self._INITIAL_CAPACITY, self._predictions.size)
+            while capacity < required:
+                capacity *= 2
+            self._predictions = self._grow(self._predictions, capacity,
+                                           prediction_dtype)
+            self._actuals = self._grow(self._actuals, capacity, actual_dtype)
+
+        self._predictions[self._size:required] = predictions
+        self._actuals[self._size:required] = actuals
+        self._size = required
+
+    def _grow(self, array, capacity, dtype):
+        grown = numpy.empty(capacity, dtype=dtype)
+        grown[:self._size] = array[:self._size]
+        return grown
+
+    def _push(self, predictions, actuals):
+        """Pushes a chunk into the heap of the top_n highest predictions."""
         heap = self._heap
+        fill = min(self._top_n - len(heap), predictions.size)
+        for pair in zip(predictions[:fill].tolist(), actuals[:fill].tolist()):
+            heapq.heappush(heap, pair)
+        if fill == predictions.size:
+            return
+
+        # Only the predictions higher than the minimum of the heap when the chunk
+        # arrives can replace it.
+        candidates = numpy.flatnonzero(
+            predictions[fill:].astype(numpy.float64) > heap[0][0]) + fill
+        for prediction, actual in zip(predictions[candidates].tolist(),
+                                      actuals[candidates].tolist()):
+            if prediction > heap[0][0]:  # heap[0] is the smallest
+                heapq.heappop(heap)
+                heapq.heappush(heap, (prediction, actual))
+
+    def _pairs(self):
+        """Gets the kept predictions and actuals in the order of the heap."""
+        if self._top_n is not None:
+            if not self._heap:
+                return numpy.empty(0), numpy.empty(0)
+            return tuple(numpy.array(list(zip(*self._heap))))
+        predictions = self._predictions[:self._size]
+        actuals = self._actuals[:self._size]
+        if _has_mixed_ties(predictions, actuals):
+            return _heap_order(predictions, actuals)
+        return predictions, actuals
+
+    def get_state(self):
+        """Gets the accumulated state as a dictionary of numpy values.
+
+        The state can be serialized (e.g. with numpy.savez) and merged into
+        another calculator with merge_state.
+        """
+        if self._top_n is None:
+            predictions = self._predictions[:self._size].copy()
+            actuals = self._actuals[:self._size].copy()
+        else:
+            predictions, actuals = self._pairs()
+        return {"top_n": -1 if self._top_n is None else self._top_n,
+                "predictions": predictions,
+                "actuals": actuals,
+                "total_positives": numpy.asarray(self._total_positives)}
+
+    def merge_state(self, state):
+        """Merges a state returned by get_state into this calculator.
+
+        The merged entries are appended after the ones already accumulated, as if
+        they had been passed to accumulate. With a top_n, they are pushed in the
+        order of the merged heap.
 
-        for i in range(numpy.size(predictions)):
-            if topk is None or len(heap) < topk:
-                heapq.heappush(heap, (predictions[i], actuals[i]))
-            else:
-                if predictions[i] > heap[0][0]:  # heap[0] is the smallest
-                    heapq.heappop(heap)
-                    heapq.heappush(heap, (predictions[i], actuals[i]))
+        Raises:
+          ValueError: An error occurred when the state was computed with a
+            different top_n.
+        """
+        top_n = int(state["top_n"])
+        if top_n != (-1 if self._top_n is None else self._top_n):
+            raise ValueError("Cannot merge a state computed with top_n=%d." % top_n)
+        self.accumulate(state["predictions"], state["actuals"],
+                        num_positives=numpy.asarray(state["total_positives"])[()])
 
     def clear(self):
         """Clear the accumulated predictions."""
         self._heap = []
+        self._predictions = numpy.empty(0, dtype=numpy.float32)
+        self._actuals = numpy.empty(0, dtype=numpy.bool_)
+        self._size = 0
         self._total_positives = 0
 
     def peek_ap_at_n(self):
@@ -146,10 +275,10 @@ class AveragePrecisionCalculator(object):
         """
         if self.heap_size <= 0:
             return 0
-        predlists = numpy.array(list(zip(*self._heap)))
+        predictions, actuals = self._pairs()
 
-        ap = self.ap_at_n(predlists[0],
-                          predlists[1],
+        ap = self.ap_at_n(predictions,
+                          actuals,
                           n=self._top_n,
                           total_num_positives=self._total_positives)
         return ap
@@ -208,18 +337,13 @@ class AveragePrecisionCalculator(object):
                 raise ValueError("n must be 'None' or a positive integer."
                                  " It was '%s'." % n)
 
-        ap = 0.0
-
         predictions = numpy.array(predictions)
         actuals = numpy.array(actuals)
 
         # add a shuffler to avoid overestimating the ap
         predictions, actuals = AveragePrecisionCalculator._shuffle(predictions,
                                                                    actuals)
-        sortidx = sorted(
-            range(len(predictions)),
-            key=lambda k: predictions[k],
-            reverse=True)
+        sortidx = AveragePrecisionCalculator._argsort_descending(predictions)
 
         if total_num_positives is None:
             numpos = numpy.size(numpy.where(actuals > 0))
@@ -232,22 +356,40 @@ class AveragePrecisionCalculator(object):
         if n is not None:
             numpos = min(numpos, n)
         delta_recall = 1.0 / numpos
-        poscount = 0.0
 
         # calculate the ap
         r = len(sortidx)
         if n is not None:
             r = min(r, n)
-        for i in range(r):
-            if actuals[sortidx[i]] > 0:
-                poscount += 1
-                ap += poscount / (i + 1) * delta_recall
+        ranks = numpy.flatnonzero(actuals[sortidx[:r]] > 0) + 1
+        if ranks.size == 0:
+            return 0.0
+        poscount = numpy.arange(1, ranks.size + 1, dtype=numpy.float64)
+        # Each term has the type of the product of a float with delta_recall,
+        # e.g. float32 when the number of positives is, and cumsum adds them left
+        # to right like a running sum.
+        dtype = numpy.asarray(0.0 * delta_recall).dtype
+        terms = (poscount / ranks).astype(dtype) * delta_recall
+        ap = numpy.cumsum(terms, dtype=dtype)[-1]
+        if not isinstance(delta_recall, numpy.generic):
+            ap = float(ap)
         return ap
 
     @staticmethod
-    def _shuffle(predictions, actuals):
+    def _argsort_descending(predictions):
+        """Stable descending argsort; equal scores keep their relative order."""
+        reversed_order = numpy.argsort(predictions[::-1], kind="stable")[::-1]
+        return len(predictions) - 1 - reversed_order
+
+    @staticmethod
+    def _shuffle_indices(size):
+        """The deterministic permutation used to break ties between scores."""
         random.seed(0)
-        suffidx = random.sample(range(len(predictions)), len(predictions))
+        return random.sample(range(size), size)
+
+    @staticmethod
+    def _shuffle(predictions, actuals):
+        suffidx = AveragePrecisionCalculator._shuffle_indices(len(predictions))
         predictions = predictions[suffidx]
         actuals = actuals[suffidx]
         return predictions, actuals
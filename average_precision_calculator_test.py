@@ -0,0 +1,119 @@
+# Copyright 2018 Deep Topology All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares AveragePrecisionCalculator with the heapq implementation it replaced."""
+
+import heapq
+import random
+import unittest
+
+import numpy
+
+import average_precision_calculator
+
+
+def reference_ap_at_n(heap, n, total_num_positives):
+    """The average precision of the former heapq-based calculator."""
+    predlists = numpy.array(list(zip(*heap)))
+    predictions, actuals = predlists[0], predlists[1]
+    random.seed(0)
+    suffidx = random.sample(range(len(predictions)), len(predictions))
+    predictions = predictions[suffidx]
+    actuals = actuals[suffidx]
+    sortidx = sorted(range(len(predictions)), key=lambda k: predictions[k],
+                     reverse=True)
+    numpos = total_num_positives
+    if numpos == 0:
+        return 0
+    if n is not None:
+        numpos = min(numpos, n)
+    delta_recall = 1.0 / numpos
+    ap = 0.0
+    poscount = 0.0
+    r = len(sortidx)
+    if n is not None:
+        r = min(r, n)
+    for i in range(r):
+        if actuals[sortidx[i]] > 0:
+            poscount += 1
+            ap += poscount / (i + 1) * delta_recall
+    return ap
+
+
+def reference_ap(chunks, top_n):
+    """Accumulates the chunks like the former heapq-based calculator."""
+    heap = []
+    total_positives = 0
+    for predictions, actuals, num_positives in chunks:
+        total_positives += num_positives
+        for i in range(numpy.size(predictions)):
+            if top_n is None or len(heap) < top_n:
+                heapq.heappush(heap, (predictions[i], actuals[i]))
+            elif predictions[i] > heap[0][0]:
+                heapq.heappop(heap)
+                heapq.heappush(heap, (predictions[i], actuals[i]))
+    if not heap:
+        return 0
+    return reference_ap_at_n(heap, top_n, total_positives)
+
+
+class AveragePrecisionCalculatorTest(unittest.TestCase):
+
+    def random_chunks(self, rng, levels):
+        chunks = []
+        for _ in range(rng.randint(1, 5)):
+            size = rng.randint(0, 60)
+            predictions = rng.rand(size).astype(numpy.float32)
+            if levels:
+                predictions = numpy.round(predictions * levels) / levels
+            actuals = (rng.rand(size) < 0.3).astype(numpy.float32)
+            num_positives = numpy.sum(actuals) + numpy.float32(rng.randint(0, 3))
+            chunks.append((predictions.astype(numpy.float32), actuals,
+                           num_positives))
+        return chunks
+
+    def assert_same_as_reference(self, chunks, top_n):
+        calculator = average_precision_calculator.AveragePrecisionCalculator(top_n)
+        for predictions, actuals, num_positives in chunks:
+            calculator.accumulate(predictions, actuals, num_positives)
+        expected = reference_ap(chunks, top_n)
+        actual = calculator.peek_ap_at_n()
+        self.assertEqual(expected, actual)
+        self.assertEqual(type(expected), type(actual))
+
+    def test_tied_predictions(self):
+        rng = numpy.random.RandomState(0)
+        for case in range(300):
+            top_n = [None, 1, 5, 20][case % 4]
+            self.assert_same_as_reference(self.random_chunks(rng, 4), top_n)
+
+    def test_float32_predictions(self):
+        rng = numpy.random.RandomState(1)
+        for case in range(300):
+            top_n = [None, 1, 5, 20][case % 4]
+            self.assert_same_as_reference(self.random_chunks(rng, None), top_n)
+
+    def test_merge_state(self):
+        rng = numpy.random.RandomState(2)
+        chunks = self.random_chunks(rng, 4)
+        calculator = average_precision_calculator.AveragePrecisionCalculator()
+        for predictions, actuals, num_positives in chunks:
+            shard = average_precision_calculator.AveragePrecisionCalculator()
+            shard.accumulate(predictions, actuals, num_positives)
+            calculator.merge_state(shard.get_state())
+        self.assertEqual(reference_ap(chunks, None), calculator.peek_ap_at_n())
+
+
+if __name__ == "__main__":
+    unittest.main()
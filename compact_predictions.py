@@ -0,0 +1,203 @@
+# Copyright 2018 Deep Topology All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact, memory-mappable format of the top-k predictions of inference.
+
+A prediction directory holds:
+  meta.json: the number of videos, top_k and the dtype of the ids. It is
+    written last, when the writer is closed, and marks the directory as
+    complete.
+  ids.bin: the video ids as fixed width byte strings.
+  class_indices.bin: int16 num_videos x top_k class indices, by decreasing
+    score.
+  scores.bin: the float16 num_videos x top_k scores.
+
+Running this file as a binary converts a prediction directory into the CSV
+submission format of inference.py. The scores are written from their float16
+values.
+
+Example usage:
+```
+python compact_predictions.py --input_dir=/tmp/predictions \
+    --output_file=/tmp/predictions.csv
+```
+"""
+# noinspection PyUnresolvedReferences
+import pathmagic
+import json
+import os
+import numpy
+
+if __name__ == "__main__":
+    # TensorFlow is only needed by the binary, the formats are numpy only.
+    from tensorflow import app
+    from tensorflow import flags
+
+    FLAGS = flags.FLAGS
+    flags.DEFINE_string("input_dir", "",
+                        "The prediction directory written by inference.py "
+                        "with --output_compact_dir.")
+    flags.DEFINE_string("output_file", "",
+                        "The CSV file to write the predictions to.")
+    flags.DEFINE_integer("batch_size", 65536,
+                         "How many videos to format at a time.")
+
+_META_FILE = "meta.json"
+CSV_HEADER = "VideoId,LabelConfidencePairs\n"
+
+
+def format_top_k_lines(video_ids, top_indices, top_scores):
+    """Formats the sorted top-k predictions of a batch of videos as CSV lines.
+
+    Args:
+      video_ids: the video ids, as bytes.
+      top_indices: the 'batch' x top_k class indices, by decreasing score.
+      top_scores: the 'batch' x top_k scores.
+
+    Yields:
+      The CSV line of every video.
+    """
+    top_k = top_indices.shape[1]
+    # The class indices are exact as float64, so both interleave in a row.
+    pairs = numpy.stack([top_indices.astype(numpy.float64),
+                         top_scores.astype(numpy.float64)], axis=2)
+    line_format = "%s," + " ".join(["%i %g"] * top_k) + "\n"
+    for video_id, values in zip(video_ids, pairs.reshape(len(video_ids), -1).tolist()):
+        yield line_format % ((video_id.decode('utf-8'),) + tuple(values))
+
+
+class CompactPredictionWriter(object):
+    """Appends the top-k predictions of batches of videos to a directory."""
+
+    def __init__(self, output_dir, top_k):
+        """Construct a CompactPredictionWriter.
+
+        Args:
+          output_dir: the local directory to write the predictions to. It is
+            created if it does not exist.
+          top_k: how many predictions are stored per video.
+        """
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        # The metadata of a previous run would mark the new files as complete.
+        if os.path.exists(os.path.join(output_dir, _META_FILE)):
+            os.remove(os.path.join(output_dir, _META_FILE))
+        self.output_dir = output_dir
+        self.top_k = top_k
+        self._ids = []
+        self._class_indices_file = open(
+            os.path.join(output_dir, "class_indices.bin"), "wb")
+        self._scores_file = open(os.path.join(output_dir, "scores.bin"), "wb")
+
+    def write(self, video_ids, top_indices, top_scores):
+        """Appends a batch of predictions.
+
+        Args:
+          video_ids: the video ids, as bytes.
+          top_indices: the 'batch' x top_k class indices, by decreasing score.
+          top_scores: the 'batch' x top_k scores.
+        """
+        if top_indices.max() > numpy.iinfo(numpy.int16).max:
+            raise ValueError("The class indices do not fit in int16.")
+        self._ids.extend(video_ids)
+        self._class_indices_file.write(
+            numpy.ascontiguousarray(top_indices, dtype=numpy.int16).tobytes())
+        self._scores_file.write(
+            numpy.ascontiguousarray(top_scores, dtype=numpy.float16).tobytes())
+
+    def close(self):
+        """Writes the video ids, then the metadata which completes the
+        directory."""
+        self._class_indices_file.close()
+        self._scores_file.close()
+        ids = numpy.array(self._ids, dtype=numpy.bytes_)
+        ids.tofile(os.path.join(self.output_dir, "ids.bin"))
+        meta = {"num_videos": len(self._ids),
+                "top_k": self.top_k,
+                "id_dtype": ids.dtype.str}
+        meta_file = os.path.join(self.output_dir, _META_FILE)
+        with open(meta_file + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.rename(meta_file + ".tmp", meta_file)
+
+
+class CompactPredictions(object):
+    """Memory maps a prediction directory."""
+
+    def __init__(self, input_dir):
+        """Construct a CompactPredictions.
+
+        Args:
+          input_dir: a directory written by CompactPredictionWriter.
+
+        Raises:
+          IOError: if the writer of the directory was not closed.
+        """
+        if not os.path.exists(os.path.join(input_dir, _META_FILE)):
+            raise IOError("%s has no %s, its predictions were not completely "
+                          "written." % (input_dir, _META_FILE))
+        with open(os.path.join(input_dir, _META_FILE)) as f:
+            meta = json.load(f)
+        self.num_videos = meta["num_videos"]
+        self.top_k = meta["top_k"]
+        shape = (self.num_videos, self.top_k)
+        if self.num_videos:
+            self.ids = numpy.memmap(os.path.join(input_dir, "ids.bin"),
+                                    dtype=numpy.dtype(meta["id_dtype"]),
+                                    mode="r", shape=(self.num_videos,))
+            self.class_indices = numpy.memmap(
+                os.path.join(input_dir, "class_indices.bin"), dtype=numpy.int16,
+                mode="r", shape=shape)
+            self.scores = numpy.memmap(os.path.join(input_dir, "scores.bin"),
+                                       dtype=numpy.float16, mode="r",
+                                       shape=shape)
+        else:
+            self.ids = numpy.zeros((0,), dtype=numpy.dtype(meta["id_dtype"]))
+            self.class_indices = numpy.zeros(shape, dtype=numpy.int16)
+            self.scores = numpy.zeros(shape, dtype=numpy.float16)
+
+
+def write_csv(predictions, out_file, batch_size=65536):
+    """Writes the predictions of a CompactPredictions in the CSV format.
+
+    Args:
+      predictions: a CompactPredictions.
+      out_file: the file object to write to.
+      batch_size: how many videos to format at a time.
+    """
+    out_file.write(CSV_HEADER)
+    for start in range(0, predictions.num_videos, batch_size):
+        stop = start + batch_size
+        out_file.write("".join(format_top_k_lines(
+            predictions.ids[start:stop], predictions.class_indices[start:stop],
+            predictions.scores[start:stop])))
+
+
+def main(unused_argv):
+    import tensorflow as tf
+    from tensorflow import gfile
+    from tensorflow import logging
+
+    logging.set_verbosity(tf.logging.INFO)
+    if not FLAGS.input_dir or not FLAGS.output_file:
+        raise ValueError("'input_dir' and 'output_file' must be specified.")
+    predictions = CompactPredictions(FLAGS.input_dir)
+    with gfile.Open(FLAGS.output_file, "w+") as out_file:
+        write_csv(predictions, out_file, FLAGS.batch_size)
+    logging.info("Wrote the predictions of %d videos to %s.",
+                 predictions.num_videos, FLAGS.output_file)
+
+
+if __name__ == "__main__":
+    app.run()
@@ -23,11 +23,14 @@ sys.path.append(os.path.join(os.getcwd(), "modules"))
 # noinspection PyUnresolvedReferences
 import pathmagic
 import glob
+import io
 import json
 import os
 import time
 import sys
+import numpy
 import eval_util
+import input_utils
 import losses
 import video_level_models
 import frame_level_models
@@ -61,7 +64,34 @@ if __name__ == "__main__":
     flags.DEFINE_integer("num_readers", 8,
                          "How many threads to use for reading input files.")
     flags.DEFINE_boolean("run_once", False, "Whether to run eval only once.")
+    flags.DEFINE_integer("eval_interval_secs", 60,
+                         "How long to wait before looking for a new "
+                         "checkpoint again, when the latest one was already "
+                         "evaluated.")
     flags.DEFINE_integer("top_k", 20, "How many predictions to output per video.")
+    flags.DEFINE_bool(
+        "graph_metrics", False,
+        "If set, the top predictions of every batch are selected in the graph "
+        "and only they are fetched to accumulate the metrics, instead of the "
+        "full predictions and labels.")
+
+    # Distributed evaluation flags.
+    flags.DEFINE_integer("num_eval_shards", 1,
+                         "Number of evaluation workers the files matched by "
+                         "--eval_data_pattern are split across.")
+    flags.DEFINE_integer("eval_shard_index", 0,
+                         "Which shard of the evaluation files this worker "
+                         "evaluates, in [0, --num_eval_shards).")
+    flags.DEFINE_string("metrics_state_file", "",
+                        "If set, the metrics state accumulated over the shard "
+                        "is written to this .npz file after every evaluation "
+                        "pass, so that it can be merged with "
+                        "--merge_metrics_states.")
+    flags.DEFINE_string("merge_metrics_states", "",
+                        "File glob of metrics states written by evaluation "
+                        "workers with --metrics_state_file. If set, no model is "
+                        "evaluated: the states are merged and the metrics over "
+                        "all shards are reported.")
 
 
 def find_class_by_name(name, modules):
@@ -73,7 +103,9 @@ def find_class_by_name(name, modules):
 def get_input_evaluation_tensors(reader,
                                  data_pattern,
                                  batch_size=1024,
-                                 num_readers=1):
+                                 num_readers=1,
+                                 num_shards=1,
+                                 shard_index=0):
     """Creates the section of the graph which reads the evaluation data.
 
       Args:
@@ -81,6 +113,8 @@ def get_input_evaluation_tensors(reader,
         data_pattern: A 'glob' style path to the data files.
         batch_size: How many examples to process at a time.
         num_readers: How many I/O threads to use.
+        num_shards: How many shards the evaluation files are split into.
+        shard_index: Which shard of the evaluation files to read.
 
       Returns:
         A tuple containing the features tensor, labels tensor, and optionally a
@@ -92,21 +126,17 @@ def get_input_evaluation_tensors(reader,
     """
     logging.info("Using batch size of " + str(batch_size) + " for evaluation.")
     with tf.name_scope("eval_input"):
-        files = gfile.Glob(data_pattern)
+        files = input_utils.get_files(data_pattern, num_shards, shard_index)
         if not files:
             raise IOError("Unable to find the evaluation files.")
         logging.info("number of evaluation files: " + str(len(files)))
-        filename_queue = tf.train.string_input_producer(
-            files, shuffle=False, num_epochs=1)
-        eval_data = [
-            reader.prepare_reader(filename_queue) for _ in range(num_readers)
-        ]
-        return tf.train.batch_join(
-            eval_data,
+        return input_utils.get_input_tensors(
+            reader,
+            files,
             batch_size=batch_size,
-            capacity=3 * batch_size,
-            allow_smaller_final_batch=True,
-            enqueue_many=True)
+            num_epochs=1,
+            num_readers=num_readers,
+            initializable=True)
 
 
 def build_graph(reader,
@@ -114,7 +144,9 @@ def build_graph(reader,
                 eval_data_pattern,
                 label_loss_fn,
                 batch_size=1024,
-                num_readers=1):
+                num_readers=1,
+                num_shards=1,
+                shard_index=0):
     """Creates the Tensorflow graph for evaluation.
 
       Args:
@@ -126,6 +158,8 @@ def build_graph(reader,
                     from BaseLoss.
         batch_size: How many examples to process at a time.
         num_readers: How many threads to use for I/O operations.
+        num_shards: How many shards the evaluation files are split into.
+        shard_index: Which shard of the evaluation files to evaluate.
     """
 
     global_step = tf.Variable(0, trainable=False, name="global_step")
@@ -134,13 +168,13 @@ def build_graph(reader,
         reader,
         eval_data_pattern,
         batch_size=batch_size,
-        num_readers=num_readers)
+        num_readers=num_readers,
+        num_shards=num_shards,
+        shard_index=shard_index)
     tf.summary.histogram("model_input_raw", model_input_raw)
 
-    feature_dim = len(model_input_raw.get_shape()) - 1
-
     # Normalize input features.
-    model_input = tf.nn.l2_normalize(model_input_raw, feature_dim)
+    model_input = utils.NormalizeModelInput(model_input_raw, num_frames)
 
     with tf.variable_scope("tower"):
         result = model.create_model(model_input,
@@ -183,80 +217,186 @@ def get_latest_checkpoint():
     return latest_index_file[:-6]
 
 
-def evaluation_loop(video_id_batch, prediction_batch, label_batch, loss,
-                    summary_op, saver, summary_writer, evl_metrics,
-                    last_global_step_val):
-    """Run the evaluation loop once.
+def write_metrics_state(path, evl_metrics, global_step_val):
+    """Writes the metrics state of this evaluation shard to an .npz file."""
+    state = evl_metrics.get_state()
+    state["global_step"] = int(global_step_val)
+    buffer = io.BytesIO()
+    numpy.savez(buffer, **state)
+    with file_io.FileIO(path, mode="wb") as f:
+        f.write(buffer.getvalue())
+    logging.info("Wrote the metrics state of %d examples to %s.",
+                 evl_metrics.num_examples, path)
+
+
+def merge_metrics_states(pattern):
+    """Merges the metrics states written by the evaluation workers.
 
       Args:
-        video_id_batch: a tensor of video ids mini-batch.
-        prediction_batch: a tensor of predictions mini-batch.
-        label_batch: a tensor of label_batch mini-batch.
-        loss: a tensor of loss for the examples in the mini-batch.
-        summary_op: a tensor which runs the tensorboard summary operations.
-        saver: a tensorflow saver to restore the model.
-        summary_writer: a tensorflow summary_writer
-        evl_metrics: an EvaluationMetrics object.
-        last_global_step_val: the global step used in the previous evaluation.
+        pattern: A 'glob' style path to the .npz metrics states.
 
       Returns:
-        The global_step used in the latest model.
+        A tuple of the EvaluationMetrics object holding the merged metrics and
+        the global step the states were computed at.
+
+      Raises:
+        IOError: If no files matching the given pattern were found.
+        ValueError: If the states were computed at different global steps.
     """
+    files = sorted(gfile.Glob(pattern))
+    if not files:
+        raise IOError("Unable to find the metrics states. pattern='" +
+                      pattern + "'")
+    evl_metrics = None
+    global_steps = set()
+    for path in files:
+        with file_io.FileIO(path, mode="rb") as f:
+            state = numpy.load(io.BytesIO(f.read()))
+        if evl_metrics is None:
+            evl_metrics = eval_util.EvaluationMetrics(int(state["num_class"]),
+                                                      int(state["top_k"]))
+        global_steps.add(int(state["global_step"]))
+        evl_metrics.merge_state(state)
+    if len(global_steps) != 1:
+        raise ValueError("The metrics states were computed at different global "
+                         "steps: %s." % sorted(global_steps))
+    logging.info("Merged %d metrics states covering %d examples.", len(files),
+                 evl_metrics.num_examples)
+    return evl_metrics, global_steps.pop()
+
+
+def report_merged_metrics():
+    """Reports the metrics over all the shards merged with --merge_metrics_states."""
+    evl_metrics, global_step_val = merge_metrics_states(FLAGS.merge_metrics_states)
+
+    epoch_info_dict = evl_metrics.get()
+    epoch_info_dict["epoch_id"] = global_step_val
+    summary_writer = tf.summary.FileWriter(FLAGS.train_dir)
+    epochinfo = utils.AddEpochSummary(
+        summary_writer,
+        global_step_val,
+        epoch_info_dict,
+        summary_scope="Eval")
+    logging.info(epochinfo)
+    summary_writer.close()
+
+
+def get_checkpoint_global_step(checkpoint):
+    """Extracts the global step from a checkpoint path."""
+    # Assuming model_checkpoint_path looks something like:
+    # /my-favorite-path/yt8m_train/model.ckpt-0, extract global_step from it.
+    return os.path.basename(checkpoint).split("-")[-1]
+
+
+def wait_for_new_checkpoint(last_global_step_val, interval_secs, run_once=False):
+    """Polls the train directory until a checkpoint newer than the last one
+    evaluated appears.
 
-    global_step_val = -1
-    with tf.Session() as sess:
+      Args:
+        last_global_step_val: the global step of the last evaluated checkpoint.
+        interval_secs: how long to sleep between two polls.
+        run_once: if set, only polls once.
+
+      Returns:
+        The new checkpoint, or None if run_once is set and there is none.
+    """
+    while True:
         latest_checkpoint = get_latest_checkpoint()
-        print(latest_checkpoint)
-        if latest_checkpoint:
-            logging.info("Loading checkpoint for eval: " + latest_checkpoint)
-            # Restores from checkpoint
-            saver.restore(sess, latest_checkpoint)
-            # Assuming model_checkpoint_path looks something like:
-            # /my-favorite-path/yt8m_train/model.ckpt-0, extract global_step from it.
-            global_step_val = os.path.basename(latest_checkpoint).split("-")[-1]
-
-            # Save model
-            saver.save(sess, os.path.join(FLAGS.train_dir, "inference_model"))
-        else:
+        if not latest_checkpoint:
             logging.info("No checkpoint file found.")
-            return global_step_val
-
-        if global_step_val == last_global_step_val:
+        elif get_checkpoint_global_step(latest_checkpoint) != last_global_step_val:
+            return latest_checkpoint
+        else:
             logging.info("skip this checkpoint global_step_val=%s "
-                         "(same as the previous one).", global_step_val)
-            return global_step_val
+                         "(same as the previous one).", last_global_step_val)
+        if run_once:
+            return None
+        time.sleep(interval_secs)
 
-        sess.run([tf.local_variables_initializer()])
 
-        # Start the queue runners.
-        fetches = [video_id_batch, prediction_batch, label_batch, loss, summary_op]
-        coord = tf.train.Coordinator()
-        try:
-            threads = []
-            for qr in tf.get_collection(tf.GraphKeys.QUEUE_RUNNERS):
-                threads.extend(qr.create_threads(
-                    sess, coord=coord, daemon=True,
-                    start=True))
-            logging.info("enter eval_once loop global_step_val = %s. ",
-                         global_step_val)
+class Evaluator(object):
+    """Evaluates checkpoints with a single session and input pipeline.
 
-            evl_metrics.clear()
+    The session and the input iterator are created once, so evaluating a new
+    checkpoint only restores its variables and restarts the iterator.
+    """
 
-            examples_processed = 0
-            while not coord.should_stop():
+    def __init__(self, saver, summary_writer, evl_metrics, graph_metrics=False):
+        """Construct an Evaluator from the graph built by build_graph.
+
+          Args:
+            saver: a tensorflow saver to restore the model.
+            summary_writer: a tensorflow summary_writer
+            evl_metrics: an EvaluationMetrics object.
+            graph_metrics: whether to only fetch the top predictions of every
+              batch, selected in the graph.
+        """
+        self.saver = saver
+        self.summary_writer = summary_writer
+        self.evl_metrics = evl_metrics
+        self.graph_metrics = graph_metrics
+        predictions = tf.get_collection("predictions")[0]
+        labels = tf.get_collection("labels")[0]
+        if graph_metrics:
+            outputs = utils.build_top_k_metrics(predictions, labels,
+                                                evl_metrics.top_k)
+        else:
+            outputs = [predictions, labels]
+        self.fetches = [outputs,
+                        tf.get_collection("loss")[0],
+                        tf.get_collection("summary_op")[0]]
+        self.input_initializer = tf.group(
+            *tf.get_collection(input_utils.INPUT_INITIALIZERS))
+
+        self.sess = tf.Session()
+        self.sess.run(tf.local_variables_initializer())
+        tf.get_default_graph().finalize()
+
+    def evaluate(self, checkpoint):
+        """Runs one evaluation pass over the data.
+
+          Args:
+            checkpoint: the checkpoint to evaluate.
+
+          Returns:
+            The global_step of the checkpoint.
+        """
+        sess = self.sess
+        evl_metrics = self.evl_metrics
+        logging.info("Loading checkpoint for eval: " + checkpoint)
+        # Restores from checkpoint
+        self.saver.restore(sess, checkpoint)
+        global_step_val = get_checkpoint_global_step(checkpoint)
+
+        # Save model
+        self.saver.save(sess, os.path.join(FLAGS.train_dir, "inference_model"))
+
+        sess.run(self.input_initializer)
+        logging.info("enter eval_once loop global_step_val = %s. ",
+                     global_step_val)
+        evl_metrics.clear()
+
+        examples_processed = 0
+        try:
+            while True:
                 batch_start_time = time.time()
-                _, predictions_val, labels_val, loss_val, summary_val = sess.run(
-                    fetches)
+                outputs_val, loss_val, summary_val = sess.run(self.fetches)
                 seconds_per_batch = time.time() - batch_start_time
-                example_per_second = labels_val.shape[0] / seconds_per_batch
-                examples_processed += labels_val.shape[0]
-
-                iteration_info_dict = evl_metrics.accumulate(predictions_val,
-                                                             labels_val, loss_val)
+                if self.graph_metrics:
+                    batch_size = outputs_val["top_indices"].shape[0]
+                    iteration_info_dict = evl_metrics.accumulate_top_k(outputs_val,
+                                                                       loss_val)
+                else:
+                    predictions_val, labels_val = outputs_val
+                    batch_size = labels_val.shape[0]
+                    iteration_info_dict = evl_metrics.accumulate(predictions_val,
+                                                                 labels_val, loss_val)
+                example_per_second = batch_size / seconds_per_batch
+                examples_processed += batch_size
                 iteration_info_dict["examples_per_second"] = example_per_second
 
                 iterinfo = utils.AddGlobalStepSummary(
-                    summary_writer,
+                    self.summary_writer,
                     global_step_val,
                     iteration_info_dict,
                     summary_scope="Eval")
@@ -270,10 +410,13 @@ def evaluation_loop(video_id_batch, prediction_batch, label_batch, loss,
             # calculate the metrics for the entire epoch
             epoch_info_dict = evl_metrics.get()
             epoch_info_dict["epoch_id"] = global_step_val
+            if FLAGS.metrics_state_file:
+                write_metrics_state(FLAGS.metrics_state_file, evl_metrics,
+                                    global_step_val)
 
-            summary_writer.add_summary(summary_val, global_step_val)
+            self.summary_writer.add_summary(summary_val, global_step_val)
             epochinfo = utils.AddEpochSummary(
-                summary_writer,
+                self.summary_writer,
                 global_step_val,
                 epoch_info_dict,
                 summary_scope="Eval")
@@ -281,13 +424,12 @@ def evaluation_loop(video_id_batch, prediction_batch, label_batch, loss,
             evl_metrics.clear()
         except Exception as e:  # pylint: disable=broad-except
             logging.info("Unexpected exception: " + str(e))
-            coord.request_stop(e)
-
-        coord.request_stop()
-        coord.join(threads, stop_grace_period_secs=10)
 
         return global_step_val
 
+    def close(self):
+        self.sess.close()
+
 
 def evaluate():
     tf.set_random_seed(0)  # for reproducibility
@@ -305,8 +447,10 @@ def evaluate():
             flags_dict["feature_names"], flags_dict["feature_sizes"])
 
         if flags_dict["frame_features"]:
+            # The frames are only dequantized by the model graph.
             reader = readers.YT8MFrameFeatureReader(feature_names=feature_names,
-                                                    feature_sizes=feature_sizes)
+                                                    feature_sizes=feature_sizes,
+                                                    dequantize=False)
         else:
             reader = readers.YT8MAggregatedFeatureReader(feature_names=feature_names,
                                                          feature_sizes=feature_sizes)
@@ -325,34 +469,38 @@ def evaluate():
             eval_data_pattern=FLAGS.eval_data_pattern,
             label_loss_fn=label_loss_fn,
             num_readers=FLAGS.num_readers,
-            batch_size=FLAGS.batch_size)
+            batch_size=FLAGS.batch_size,
+            num_shards=FLAGS.num_eval_shards,
+            shard_index=FLAGS.eval_shard_index)
         logging.info("built evaluation graph")
-        video_id_batch = tf.get_collection("video_id_batch")[0]
-        prediction_batch = tf.get_collection("predictions")[0]
-        label_batch = tf.get_collection("labels")[0]
-        loss = tf.get_collection("loss")[0]
-        summary_op = tf.get_collection("summary_op")[0]
 
         saver = tf.train.Saver(tf.global_variables())
         summary_writer = tf.summary.FileWriter(
             FLAGS.train_dir, graph=tf.get_default_graph())
 
         evl_metrics = eval_util.EvaluationMetrics(reader.num_classes, FLAGS.top_k)
+        evaluator = Evaluator(saver, summary_writer, evl_metrics,
+                              FLAGS.graph_metrics)
 
         last_global_step_val = -1
         while True:
-            last_global_step_val = evaluation_loop(video_id_batch, prediction_batch,
-                                                   label_batch, loss, summary_op,
-                                                   saver, summary_writer, evl_metrics,
-                                                   last_global_step_val)
+            checkpoint = wait_for_new_checkpoint(last_global_step_val,
+                                                 FLAGS.eval_interval_secs,
+                                                 FLAGS.run_once)
+            if checkpoint:
+                last_global_step_val = evaluator.evaluate(checkpoint)
             if FLAGS.run_once:
                 break
+        evaluator.close()
 
 
 def main(unused_argv):
     logging.set_verbosity(tf.logging.INFO)
     print("tensorflow version: %s" % tf.__version__)
-    evaluate()
+    if FLAGS.merge_metrics_states:
+        report_merged_metrics()
+    else:
+        evaluate()
 
 
 if __name__ == "__main__":
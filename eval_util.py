@@ -52,20 +52,41 @@ def calculate_precision_at_equal_recall_rate(predictions, actuals):
     Returns:
     float: The average precision at equal recall rate across the entire batch.
     """
-    aggregated_precision = 0.0
-    num_videos = actuals.shape[0]
-    for row in numpy.arange(num_videos):
-        num_labels = int(numpy.sum(actuals[row]))
-        top_indices = numpy.argpartition(predictions[row],
-                                     -num_labels)[-num_labels:]
-        item_precision = 0.0
-        for label_index in top_indices:
-            if predictions[row][label_index] > 0:
-                item_precision += actuals[row][label_index]
-        item_precision /= top_indices.size
-        aggregated_precision += item_precision
-    aggregated_precision /= num_videos
-    return aggregated_precision
+    num_labels = numpy.sum(actuals, axis=1).astype(numpy.int64)
+    top_indices, top_predictions = sorted_top_k(predictions, num_labels.max())
+    top_actuals = numpy.take_along_axis(actuals, top_indices, axis=1)
+    return _average_precision_at_num_labels(top_predictions, top_actuals,
+                                             num_labels)
+
+
+def _average_precision_at_num_labels(top_predictions, top_actuals, num_labels):
+    """Averages, over the videos, the precision of the first num_labels[i]
+    entries of each row of the descending top predictions."""
+    in_top = numpy.arange(top_predictions.shape[1]) < num_labels[:, None]
+    hits = numpy.sum(numpy.where(in_top & (top_predictions > 0), top_actuals, 0),
+                     axis=1)
+    precision = numpy.where(num_labels > 0,
+                            hits / numpy.maximum(num_labels, 1), 0.0)
+    return numpy.mean(precision)
+
+
+def sorted_top_k(predictions, k):
+    """Gets the top k predictions of every row, sorted by descending score.
+
+    Args:
+    predictions: Matrix containing the outputs of the model.
+      Dimensions are 'batch' x 'num_classes'.
+    k: How many predictions to keep per row. It is clipped to [1, num_classes].
+
+    Returns:
+    A tuple (indices, predictions) of 'batch' x k matrices.
+    """
+    k = int(min(max(k, 1), predictions.shape[1]))
+    top_indices = numpy.argpartition(predictions, -k, axis=1)[:, -k:]
+    top_predictions = numpy.take_along_axis(predictions, top_indices, axis=1)
+    order = numpy.argsort(-top_predictions, axis=1, kind="stable")
+    return (numpy.take_along_axis(top_indices, order, axis=1),
+            numpy.take_along_axis(top_predictions, order, axis=1))
 
 
 def calculate_gap(predictions, actuals, top_k=20):
@@ -84,8 +105,27 @@ def calculate_gap(predictions, actuals, top_k=20):
     float: The global average precision.
     """
     gap_calculator = ap_calculator.AveragePrecisionCalculator()
-    sparse_predictions, sparse_labels, num_positives = top_k_by_class(predictions, actuals, top_k)
-    gap_calculator.accumulate(flatten(sparse_predictions), flatten(sparse_labels), sum(num_positives))
+    _, sparse_predictions, sparse_labels, num_positives = top_k_triplets_by_class(
+        predictions, actuals, top_k)
+    gap_calculator.accumulate(sparse_predictions, sparse_labels, numpy.sum(num_positives))
+    return gap_calculator.peek_ap_at_n()
+
+
+def calculate_gap_top_k(top_predictions, top_labels, num_positives):
+    """Performs a local (numpy) calculation of the global average precision from
+    the outputs of utils.build_top_k_metrics.
+
+    Args:
+    top_predictions: The 'batch' x top_k highest predictions of every video.
+    top_labels: The 'batch' x top_k ground truth labels of these predictions.
+    num_positives: The number of positives of every class in the batch.
+
+    Returns:
+    float: The global average precision.
+    """
+    gap_calculator = ap_calculator.AveragePrecisionCalculator()
+    gap_calculator.accumulate(top_predictions.reshape(-1), top_labels.reshape(-1),
+                              numpy.sum(num_positives))
     return gap_calculator.peek_ap_at_n()
 
 
@@ -106,24 +146,67 @@ def top_k_by_class(predictions, labels, k=20):
     those predictions. The entries in 'true_positives' are the number of true
     positives for each class in the ground truth.
 
+    Raises:
+    ValueError: An error occurred when the k is not a positive integer.
+    """
+    class_indices, flat_predictions, flat_labels, true_positives = (
+        top_k_triplets_by_class(predictions, labels, k))
+    num_classes = predictions.shape[1]
+    splits = numpy.cumsum(numpy.bincount(class_indices, minlength=num_classes))[:-1]
+    out_predictions = numpy.split(flat_predictions, splits)
+    out_labels = numpy.split(flat_labels, splits)
+    return out_predictions, out_labels, list(true_positives)
+
+
+def top_k_triplets_by_class(predictions, labels, k=20):
+    """Extracts the top k predictions for each video as flat arrays.
+
+    A single argpartition over the whole batch selects the top k classes of
+    every video. The resulting (class, prediction, label) triplets are sorted by
+    class and, within a class, by video.
+
+    Args:
+    predictions: A numpy matrix containing the outputs of the model.
+      Dimensions are 'batch' x 'num_classes'.
+    labels: A numpy matrix containing the ground truth labels.
+      Dimensions are 'batch' x 'num_classes'.
+    k: the top k non-zero entries to preserve in each prediction.
+
+    Returns:
+    A tuple (class_indices, predictions, labels, true_positives). The first
+    three are 1-D arrays of size 'batch' * k holding the triplets.
+    'true_positives' is an array with the number of true positives for each
+    class in the ground truth.
+
     Raises:
     ValueError: An error occurred when the k is not a positive integer.
     """
     if k <= 0:
         raise ValueError("k must be a positive integer.")
     k = min(k, predictions.shape[1])
-    num_classes = predictions.shape[1]
-    prediction_triplets= []
-    for video_index in range(predictions.shape[0]):
-        prediction_triplets.extend(top_k_triplets(predictions[video_index],labels[video_index], k))
-    out_predictions = [[] for v in range(num_classes)]
-    out_labels = [[] for v in range(num_classes)]
-    for triplet in prediction_triplets:
-        out_predictions[triplet[0]].append(triplet[1])
-        out_labels[triplet[0]].append(triplet[2])
-    out_true_positives = [numpy.sum(labels[:,i]) for i in range(num_classes)]
+    top_indices = numpy.argpartition(predictions, -k, axis=1)[:, -k:]
+    top_predictions = numpy.take_along_axis(predictions, top_indices, axis=1)
+    top_labels = numpy.take_along_axis(labels, top_indices, axis=1)
+    return sort_triplets_by_class(top_indices, top_predictions, top_labels) + (
+        numpy.sum(labels, axis=0),)
 
-    return out_predictions, out_labels, out_true_positives
+
+def sort_triplets_by_class(top_indices, top_predictions, top_labels):
+    """Flattens the top predictions of every video into triplets sorted by
+    class and, within a class, by video.
+
+    Args:
+    top_indices: The 'batch' x k class indices of the top predictions.
+    top_predictions: The 'batch' x k top predictions.
+    top_labels: The 'batch' x k ground truth labels of these predictions.
+
+    Returns:
+    A tuple (class_indices, predictions, labels) of 1-D arrays.
+    """
+    class_indices = top_indices.reshape(-1)
+    order = numpy.argsort(class_indices, kind="stable")
+    return (class_indices[order], top_predictions.reshape(-1)[order],
+            top_labels.reshape(-1)[order])
 
 
 def top_k_triplets(predictions, labels, k=20):
@@ -140,6 +223,11 @@ class EvaluationMetrics(object):
     def __init__(self, num_class, top_k):
         """Construct an EvaluationMetrics object to store the evaluation metrics.
 
+        The mAP and GAP calculators keep all the top_k predictions of every
+        video, in flat arrays of 12 and 8 bytes per float32 prediction, e.g.
+        about 240MB and 160MB for 1M videos and a top_k of 20. The arrays grow
+        by doubling, so they can take up to twice as much.
+
         Args:
           num_class: A positive integer specifying the number of classes.
           top_k: A positive integer specifying how many predictions are considered per video.
@@ -153,6 +241,7 @@ class EvaluationMetrics(object):
         self.sum_loss = 0.0
         self.map_calculator = map_calculator.MeanAveragePrecisionCalculator(num_class)
         self.global_ap_calculator = ap_calculator.AveragePrecisionCalculator()
+        self.num_class = num_class
         self.top_k = top_k
         self.num_examples = 0
 
@@ -179,9 +268,44 @@ class EvaluationMetrics(object):
         mean_loss = numpy.mean(loss)
 
         # Take the top 20 predictions.
-        sparse_predictions, sparse_labels, num_positives = top_k_by_class(predictions, labels, self.top_k)
-        self.map_calculator.accumulate(sparse_predictions, sparse_labels, num_positives)
-        self.global_ap_calculator.accumulate(flatten(sparse_predictions), flatten(sparse_labels), sum(num_positives))
+        class_indices, sparse_predictions, sparse_labels, num_positives = (
+            top_k_triplets_by_class(predictions, labels, self.top_k))
+        self.map_calculator.accumulate_triplets(class_indices, sparse_predictions,
+                                                sparse_labels, num_positives)
+        self.global_ap_calculator.accumulate(sparse_predictions, sparse_labels,
+                                             numpy.sum(num_positives))
+
+        self.num_examples += batch_size
+        self.sum_hit_at_one += mean_hit_at_one * batch_size
+        self.sum_perr += mean_perr * batch_size
+        self.sum_loss += mean_loss * batch_size
+
+        return {"hit_at_one": mean_hit_at_one, "perr": mean_perr, "loss": mean_loss}
+
+    def accumulate_top_k(self, metrics, loss):
+        """Accumulate the metrics computed in the graph for this mini-batch.
+
+        Args:
+          metrics: A dictionary of the numpy values of the tensors built by
+            utils.build_top_k_metrics, with top_k equal to the top_k of this object.
+          loss: A numpy array containing the loss for each sample.
+
+        Returns:
+          dictionary: A dictionary storing the metrics for the mini-batch.
+        """
+        batch_size = metrics["top_indices"].shape[0]
+        mean_hit_at_one = float(metrics["hit_at_one"])
+        mean_perr = float(metrics["perr"])
+        mean_loss = numpy.mean(loss)
+
+        class_indices, sparse_predictions, sparse_labels = sort_triplets_by_class(
+            metrics["top_indices"], metrics["top_predictions"],
+            metrics["top_labels"])
+        num_positives = metrics["num_positives"]
+        self.map_calculator.accumulate_triplets(class_indices, sparse_predictions,
+                                                sparse_labels, num_positives)
+        self.global_ap_calculator.accumulate(sparse_predictions, sparse_labels,
+                                             numpy.sum(num_positives))
 
         self.num_examples += batch_size
         self.sum_hit_at_one += mean_hit_at_one * batch_size
@@ -214,6 +338,52 @@ class EvaluationMetrics(object):
         return {"avg_hit_at_one": avg_hit_at_one, "avg_perr": avg_perr,
                 "avg_loss": avg_loss, "aps": aps, "gap": gap}
 
+    def get_state(self):
+        """Gets the accumulated metrics as a flat dictionary of numpy values.
+
+        The state of an evaluation over a shard of the data can be saved with
+        numpy.savez and merged with the states of the other shards via
+        merge_state, which gives the same metrics as a single evaluation over
+        all the shards.
+
+        Returns:
+          dictionary: the running sums, the number of examples and the state of
+            the mAP and GAP calculators.
+        """
+        state = {"num_class": self.num_class,
+                 "top_k": self.top_k,
+                 "num_examples": self.num_examples,
+                 "sum_hit_at_one": self.sum_hit_at_one,
+                 "sum_perr": self.sum_perr,
+                 "sum_loss": self.sum_loss}
+        for key, value in self.map_calculator.get_state().items():
+            state["map_" + key] = value
+        for key, value in self.global_ap_calculator.get_state().items():
+            state["gap_" + key] = value
+        return state
+
+    def merge_state(self, state):
+        """Merges a state returned by get_state into this object.
+
+        Args:
+          state: A dictionary (or a loaded .npz file) returned by get_state.
+
+        Raises:
+          ValueError: An error occurred when the state was computed for a
+            different number of classes or top_k.
+        """
+        if int(state["num_class"]) != self.num_class or int(state["top_k"]) != self.top_k:
+            raise ValueError("Cannot merge metrics computed with num_class=%d and "
+                             "top_k=%d." % (state["num_class"], state["top_k"]))
+        self.num_examples += int(state["num_examples"])
+        self.sum_hit_at_one += float(state["sum_hit_at_one"])
+        self.sum_perr += float(state["sum_perr"])
+        self.sum_loss += float(state["sum_loss"])
+        self.map_calculator.merge_state(
+            {key[len("map_"):]: state[key] for key in state.keys() if key.startswith("map_")})
+        self.global_ap_calculator.merge_state(
+            {key[len("gap_"):]: state[key] for key in state.keys() if key.startswith("gap_")})
+
     def clear(self):
         """Clear the evaluation metrics and reset the EvaluationMetrics object."""
         self.sum_hit_at_one = 0.0
@@ -14,8 +14,12 @@
 """Utilities to export a model for batch prediction."""
 # noinspection PyUnresolvedReferences
 import pathmagic
+import os
+import threading
 import tensorflow as tf
 import tensorflow.contrib.slim as slim
+from tensorflow import gfile
+from tensorflow import logging
 
 from tensorflow.python.saved_model import builder as saved_model_builder
 from tensorflow.python.saved_model import signature_constants
@@ -23,6 +27,13 @@ from tensorflow.python.saved_model import signature_def_utils
 from tensorflow.python.saved_model import tag_constants
 from tensorflow.python.saved_model import utils as saved_model_utils
 
+import utils
+
+try:
+    import queue            # Python 3
+except ImportError:
+    import Queue as queue   # Python 2
+
 _TOP_PREDICTIONS_IN_OUTPUT = 20
 
 
@@ -60,19 +71,12 @@ class ModelExporter(object):
                 model_builder.save()
 
     def build_inputs_and_outputs(self):
-        if self.frame_features:
-            serialized_examples = tf.placeholder(tf.string, shape=(None,))
-
-            fn = lambda x: self.build_prediction_graph(x)
-            video_id_output, top_indices_output, top_predictions_output = (
-                tf.map_fn(fn, serialized_examples,
-                          dtype=(tf.string, tf.int32, tf.float32)))
+        # Both readers parse the whole batch of examples at once, so the model
+        # runs once per request.
+        serialized_examples = tf.placeholder(tf.string, shape=(None,))
 
-        else:
-            serialized_examples = tf.placeholder(tf.string, shape=(None,))
-
-            video_id_output, top_indices_output, top_predictions_output = (
-                self.build_prediction_graph(serialized_examples))
+        video_id_output, top_indices_output, top_predictions_output = (
+            self.build_prediction_graph(serialized_examples))
 
         inputs = {"example_bytes":
                       saved_model_utils.build_tensor_info(serialized_examples)}
@@ -88,8 +92,7 @@ class ModelExporter(object):
         video_id, model_input_raw, labels_batch, num_frames = (
             self.reader.prepare_serialized_examples(serialized_examples))
 
-        feature_dim = len(model_input_raw.get_shape()) - 1
-        model_input = tf.nn.l2_normalize(model_input_raw, feature_dim)
+        model_input = utils.NormalizeModelInput(model_input_raw, num_frames)
 
         with tf.variable_scope("tower"):
             result = self.model.create_model(
@@ -97,7 +100,8 @@ class ModelExporter(object):
                 num_frames=num_frames,
                 vocab_size=self.reader.num_classes,
                 labels=labels_batch,
-                is_training=False)
+                is_training=False,
+                reader_sampling=getattr(self.reader, "frame_sampling", None))
 
             for variable in slim.get_model_variables():
                 tf.summary.histogram(variable.op.name, variable)
@@ -107,3 +111,89 @@ class ModelExporter(object):
             top_predictions, top_indices = tf.nn.top_k(predictions,
                                                        _TOP_PREDICTIONS_IN_OUTPUT)
         return video_id, top_indices, top_predictions
+
+
+class AsyncModelExporter(object):
+    """Exports checkpoints with a ModelExporter in a background thread.
+
+    The checkpoints are exported to export_dir/step_<global step>. At most
+    max_pending exports wait in the queue; a checkpoint submitted without
+    blocking when it is full is not exported, so that training does not wait
+    for an export.
+    """
+
+    def __init__(self, model_exporter, export_dir, keep=0, max_pending=1):
+        """Construct an AsyncModelExporter and start its thread.
+
+        Args:
+          model_exporter: the ModelExporter which writes the SavedModels.
+          export_dir: the directory of the exports.
+          keep: how many of the latest exports to keep, 0 to keep them all.
+          max_pending: how many checkpoints can wait to be exported.
+        """
+        self.model_exporter = model_exporter
+        self.export_dir = export_dir
+        self.keep = keep
+        self._checkpoints = queue.Queue(max_pending)
+        self._thread = threading.Thread(target=self._export_checkpoints)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def full(self):
+        """Whether a checkpoint submitted without blocking would be skipped."""
+        return self._checkpoints.full()
+
+    def submit(self, global_step_val, checkpoint, block=False):
+        """Queues a checkpoint to be exported.
+
+        Args:
+          global_step_val: the global step of the checkpoint.
+          checkpoint: the path of the checkpoint.
+          block: whether to wait for the queue to have room, e.g. for the last
+            checkpoint of the training.
+
+        Returns:
+          Whether the checkpoint was queued.
+        """
+        try:
+            self._checkpoints.put((global_step_val, checkpoint), block)
+            return True
+        except queue.Full:
+            logging.warning("Skipping the export of step %s, the previous "
+                            "export is still running.", global_step_val)
+            return False
+
+    def close(self):
+        """Waits for the queued exports to finish."""
+        self._checkpoints.put(None)
+        self._thread.join()
+
+    def _export_checkpoints(self):
+        while True:
+            item = self._checkpoints.get()
+            if item is None:
+                return
+            global_step_val, checkpoint = item
+            model_dir = os.path.join(self.export_dir,
+                                     "step_{0}".format(global_step_val))
+            try:
+                self.model_exporter.export_model(
+                    model_dir=model_dir,
+                    global_step_val=global_step_val,
+                    last_checkpoint=checkpoint)
+                logging.info("Exported the model at step %s to %s.",
+                             global_step_val, model_dir)
+                self._remove_old_exports()
+            except Exception as e:
+                logging.error("Failed to export the model at step %s: %s",
+                              global_step_val, e)
+
+    def _remove_old_exports(self):
+        if not self.keep:
+            return
+        steps = sorted(int(name.strip("/").split("_")[1])
+                       for name in gfile.ListDirectory(self.export_dir)
+                       if name.startswith("step_"))
+        for step in steps[:-self.keep]:
+            gfile.DeleteRecursively(
+                os.path.join(self.export_dir, "step_{0}".format(step)))
@@ -0,0 +1,247 @@
+# Copyright 2018 Deep Topology All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Preprocessed, memory-mapped cache of frame-level features.
+
+Running this file as a binary converts frame-level TFRecords into a cache
+directory, which holds:
+  meta.json: the feature names and sizes and the array sizes.
+  <feature_name>.bin: uint8 frame matrix of every feature, the frames of all
+    the videos stored contiguously, one row per frame.
+  frame_offsets.bin: int64, the frames of video i are rows
+    [frame_offsets[i], frame_offsets[i + 1]).
+  labels.bin, label_offsets.bin: int32 label indices and their int64 offsets.
+  ids.bin: the video ids as fixed width byte strings.
+
+The features stay quantized, so FrameCache serves a batch by slicing the
+memory-mapped matrices and the dequantization is done in the input graph.
+
+Example usage:
+```
+python frame_cache.py --input_data_pattern="train*.tfrecord" \
+    --cache_dir=/local/yt8m_train_cache --feature_names="rgb,audio" \
+    --feature_sizes="1024,128"
+```
+"""
+# noinspection PyUnresolvedReferences
+import pathmagic
+import json
+import os
+import numpy
+import tensorflow as tf
+from tensorflow import app
+from tensorflow import flags
+from tensorflow import gfile
+from tensorflow import logging
+
+import utils
+
+FLAGS = flags.FLAGS
+
+if __name__ == "__main__":
+    flags.DEFINE_string("input_data_pattern", "",
+                        "Comma separated file globs of the frame-level "
+                        "TFRecords to convert.")
+    flags.DEFINE_string("cache_dir", "",
+                        "The local directory to write the cache to.")
+    flags.DEFINE_string("feature_names", "rgb,audio",
+                        "Name of the features to store.")
+    flags.DEFINE_string("feature_sizes", "1024,128",
+                        "Length of the feature vectors.")
+
+_META_FILE = "meta.json"
+
+
+class FrameCacheWriter(object):
+    """Appends videos to a new frame cache directory."""
+
+    def __init__(self, cache_dir, feature_names, feature_sizes):
+        """Construct a FrameCacheWriter.
+
+        Args:
+          cache_dir: the directory to write the cache to. It is created if it
+            does not exist.
+          feature_names: the feature name(s) to store as a list.
+          feature_sizes: the feature dimension(s) as a list.
+        """
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.cache_dir = cache_dir
+        self.feature_names = list(feature_names)
+        self.feature_sizes = list(feature_sizes)
+        self._feature_files = [
+            open(os.path.join(cache_dir, name + ".bin"), "wb")
+            for name in self.feature_names]
+        self._labels_file = open(os.path.join(cache_dir, "labels.bin"), "wb")
+        self._ids = []
+        self._frame_offsets = [0]
+        self._label_offsets = [0]
+
+    def write(self, video_id, labels, frames):
+        """Appends a video.
+
+        Args:
+          video_id: the video id, as bytes.
+          labels: the label indices of the video.
+          frames: a list with, for every feature, the quantized frames as a
+            bytes string of num_frames * feature_size bytes.
+        """
+        num_frames = len(frames[0]) // self.feature_sizes[0]
+        for f, data, feature_size in zip(self._feature_files, frames,
+                                         self.feature_sizes):
+            if len(data) != num_frames * feature_size:
+                raise ValueError("Video %s has features with different numbers "
+                                 "of frames." % video_id)
+            f.write(data)
+        labels = numpy.asarray(labels, dtype=numpy.int32)
+        self._labels_file.write(labels.tobytes())
+        self._ids.append(video_id)
+        self._frame_offsets.append(self._frame_offsets[-1] + num_frames)
+        self._label_offsets.append(self._label_offsets[-1] + labels.size)
+
+    def close(self):
+        """Writes the index files and the metadata."""
+        for f in self._feature_files + [self._labels_file]:
+            f.close()
+        ids = numpy.array(self._ids, dtype=numpy.bytes_)
+        ids.tofile(os.path.join(self.cache_dir, "ids.bin"))
+        numpy.array(self._frame_offsets, dtype=numpy.int64).tofile(
+            os.path.join(self.cache_dir, "frame_offsets.bin"))
+        numpy.array(self._label_offsets, dtype=numpy.int64).tofile(
+            os.path.join(self.cache_dir, "label_offsets.bin"))
+        meta = {"feature_names": self.feature_names,
+                "feature_sizes": self.feature_sizes,
+                "num_videos": len(self._ids),
+                "num_frames": self._frame_offsets[-1],
+                "num_labels": self._label_offsets[-1],
+                "id_dtype": ids.dtype.str}
+        with open(os.path.join(self.cache_dir, _META_FILE), "w") as f:
+            json.dump(meta, f)
+
+
+class FrameCache(object):
+    """Reads a frame cache directory through memory maps."""
+
+    def __init__(self, cache_dir):
+        """Construct a FrameCache.
+
+        Args:
+          cache_dir: a directory written by FrameCacheWriter.
+        """
+        with open(os.path.join(cache_dir, _META_FILE)) as f:
+            meta = json.load(f)
+        self.cache_dir = cache_dir
+        self.feature_names = meta["feature_names"]
+        self.feature_sizes = meta["feature_sizes"]
+        self.num_videos = meta["num_videos"]
+
+        self.frames = dict(
+            (name, self._map(name + ".bin", numpy.uint8,
+                             (meta["num_frames"], size)))
+            for name, size in zip(self.feature_names, self.feature_sizes))
+        self.frame_offsets = self._map("frame_offsets.bin", numpy.int64,
+                                       (self.num_videos + 1,))
+        self.label_offsets = self._map("label_offsets.bin", numpy.int64,
+                                       (self.num_videos + 1,))
+        self.labels = self._map("labels.bin", numpy.int32, (meta["num_labels"],))
+        self.ids = self._map("ids.bin", numpy.dtype(meta["id_dtype"]),
+                             (self.num_videos,))
+        self.num_frames = numpy.diff(self.frame_offsets)
+
+    def _map(self, name, dtype, shape):
+        if not numpy.prod(shape):
+            return numpy.zeros(shape, dtype=dtype)
+        return numpy.memmap(os.path.join(self.cache_dir, name), dtype=dtype,
+                            mode="r", shape=shape)
+
+    def get_batch(self, video_indices, feature_names, max_frames, num_classes):
+        """Gathers a batch of videos.
+
+        Every video's frames are a contiguous slice of the memory-mapped
+        matrices, copied once into the padded uint8 output.
+
+        Args:
+          video_indices: the indices of the videos of the batch.
+          feature_names: the names of the features to concatenate.
+          max_frames: the number of frames (rows) of every output video.
+          num_classes: the number of classes of the label matrix.
+
+        Returns:
+          A tuple of the video ids, the 'batch' x max_frames x 'feature_size'
+          uint8 frames padded with zeros, the 'batch' x num_classes bool labels
+          and the number of frames of every video.
+        """
+        video_indices = numpy.asarray(video_indices)
+        batch_size = video_indices.size
+        feature_sizes = [self.feature_sizes[self.feature_names.index(name)]
+                         for name in feature_names]
+        column_offsets = numpy.cumsum([0] + feature_sizes)
+
+        frames = numpy.zeros((batch_size, max_frames, column_offsets[-1]),
+                             dtype=numpy.uint8)
+        labels = numpy.zeros((batch_size, num_classes), dtype=numpy.bool_)
+        num_frames = numpy.minimum(self.num_frames[video_indices], max_frames)
+        for row, video in enumerate(video_indices):
+            start = self.frame_offsets[video]
+            stop = start + num_frames[row]
+            for name, left, right in zip(feature_names, column_offsets[:-1],
+                                         column_offsets[1:]):
+                frames[row, :num_frames[row], left:right] = self.frames[name][start:stop]
+            labels[row, self.labels[self.label_offsets[video]:
+                                    self.label_offsets[video + 1]]] = True
+        return (numpy.asarray(self.ids[video_indices]), frames, labels,
+                num_frames.astype(numpy.int32))
+
+
+def convert(files, cache_dir, feature_names, feature_sizes):
+    """Converts frame-level TFRecords into a frame cache.
+
+    Args:
+      files: the list of TFRecord files of SequenceExamples.
+      cache_dir: the directory to write the cache to.
+      feature_names: the feature name(s) to store as a list.
+      feature_sizes: the feature dimension(s) as a list.
+    """
+    writer = FrameCacheWriter(cache_dir, feature_names, feature_sizes)
+    for path in files:
+        logging.info("Converting %s.", path)
+        for record in tf.python_io.tf_record_iterator(path):
+            example = tf.train.SequenceExample.FromString(record)
+            context = example.context.feature
+            frames = [b"".join(feature.bytes_list.value[0] for feature in
+                               example.feature_lists.feature_list[name].feature)
+                      for name in feature_names]
+            writer.write(context["id"].bytes_list.value[0],
+                         context["labels"].int64_list.value, frames)
+    writer.close()
+
+
+def main(unused_argv):
+    logging.set_verbosity(tf.logging.INFO)
+    feature_names, feature_sizes = utils.GetListOfFeatureNamesAndSizes(
+        FLAGS.feature_names, FLAGS.feature_sizes)
+    files = []
+    for pattern in FLAGS.input_data_pattern.split(","):
+        files.extend(gfile.Glob(pattern.strip()))
+    if not files:
+        raise IOError("Unable to find input files. data_pattern='" +
+                      FLAGS.input_data_pattern + "'")
+    if not FLAGS.cache_dir:
+        raise ValueError("'cache_dir' was not specified.")
+    convert(sorted(files), FLAGS.cache_dir, feature_names, feature_sizes)
+    logging.info("Wrote the frame cache to %s.", FLAGS.cache_dir)
+
+
+if __name__ == "__main__":
+    app.run()
@@ -104,7 +104,8 @@ class JuhanTestModelV1(models.BaseModel):
         use_relu = FLAGS.jtmv1_use_relu
 
         num_frames = tf.cast(tf.expand_dims(num_frames, 1), tf.float32)
-        model_input = utils.SampleRandomFrames(model_input, num_frames, iterations)
+        model_input = utils.SampleRandomFrames(model_input, num_frames, iterations,
+                                               reader_sampling=unused_params.get("reader_sampling"))
         # model_input: batch_size x max_frames x feature_size
         max_frames = model_input.get_shape().as_list()[1]
         feature_size = model_input.get_shape().as_list()[2]
@@ -208,7 +209,8 @@ class JuhanTestModelV2(models.BaseModel):
         use_relu = FLAGS.jtmv2_use_relu
 
         num_frames = tf.cast(tf.expand_dims(num_frames, 1), tf.float32)
-        model_input = utils.SampleRandomFrames(model_input, num_frames, iterations)
+        model_input = utils.SampleRandomFrames(model_input, num_frames, iterations,
+                                               reader_sampling=unused_params.get("reader_sampling"))
         # model_input: batch_size x max_frames x feature_size
         max_frames = model_input.get_shape().as_list()[1]
         feature_size = model_input.get_shape().as_list()[2]
@@ -325,7 +327,8 @@ class JuhanTestModelV3(models.BaseModel):
         video_level_model = FLAGS.jtmv3_video_level_model
 
         num_frames = tf.cast(tf.expand_dims(num_frames, 1), tf.float32)
-        model_input = utils.SampleRandomFrames(model_input, num_frames, iterations)
+        model_input = utils.SampleRandomFrames(model_input, num_frames, iterations,
+                                               reader_sampling=unused_params.get("reader_sampling"))
         # model_input: batch_size x max_frames x feature_size
         max_frames = model_input.get_shape().as_list()[1]
         feature_size = model_input.get_shape().as_list()[2]
@@ -434,7 +437,8 @@ class JuhanTestModelV4(models.BaseModel):
         video_level_model = FLAGS.jtmv3_video_level_model
 
         num_frames = tf.cast(tf.expand_dims(num_frames, 1), tf.float32)
-        model_input = utils.SampleRandomFrames(model_input, num_frames, iterations)
+        model_input = utils.SampleRandomFrames(model_input, num_frames, iterations,
+                                               reader_sampling=unused_params.get("reader_sampling"))
         # model_input: batch_size x max_frames x feature_size
         max_frames = model_input.get_shape().as_list()[1]
         feature_size = model_input.get_shape().as_list()[2]
@@ -535,7 +539,8 @@ class JuhanTestModelV5(models.BaseModel):
         audio_output_dim = FLAGS.jtmv5_audio_output_dim
 
         num_frames = tf.cast(tf.expand_dims(num_frames, 1), tf.float32)
-        model_input = utils.SampleRandomFrames(model_input, num_frames, iterations)
+        model_input = utils.SampleRandomFrames(model_input, num_frames, iterations,
+                                               reader_sampling=unused_params.get("reader_sampling"))
         # model_input: batch_size x max_frames x feature_size
         max_frames = model_input.get_shape().as_list()[1]
         feature_size = model_input.get_shape().as_list()[2]
@@ -660,7 +665,8 @@ class JuhanTestModelV6(models.BaseModel):
         audio_cluster_size = FLAGS.jtmv6_audio_cluster_size
 
         num_frames = tf.cast(tf.expand_dims(num_frames, 1), tf.float32)
-        model_input = utils.SampleRandomFrames(model_input, num_frames, iterations)
+        model_input = utils.SampleRandomFrames(model_input, num_frames, iterations,
+                                               reader_sampling=unused_params.get("reader_sampling"))
         # model_input: batch_size x max_frames x feature_size
         max_frames = model_input.get_shape().as_list()[1]
         feature_size = model_input.get_shape().as_list()[2]
@@ -775,7 +781,8 @@ class TriangulationCnnClusterModel(models.BaseModel):
         audio_hidden_size = FLAGS.tccm_audio_hidden
 
         num_frames = tf.cast(tf.expand_dims(num_frames, 1), tf.float32)
-        model_input = utils.SampleRandomFrames(model_input, num_frames, iterations)
+        model_input = utils.SampleRandomFrames(model_input, num_frames, iterations,
+                                               reader_sampling=unused_params.get("reader_sampling"))
         # model_input: batch_size x max_frames x feature_size
         max_frames = model_input.get_shape().as_list()[1]
         feature_size = model_input.get_shape().as_list()[2]
@@ -981,7 +988,8 @@ class SoftAttentionTriangulationModel(models.BaseModel):
         audio_bottleneck = FLAGS.sftm_audio_bottleneck
 
         num_frames      = tf.cast(tf.expand_dims(num_frames, 1), tf.float32)
-        model_input     = utils.SampleRandomFrames(model_input, num_frames, iterations)
+        model_input     = utils.SampleRandomFrames(model_input, num_frames, iterations,
+                                                   reader_sampling=unused_params.get("reader_sampling"))
         # model_input: batch_size x max_frames x feature_size
         max_frames      = model_input.get_shape().as_list()[1]
         feature_size    = model_input.get_shape().as_list()[2]
@@ -1162,7 +1170,8 @@ class RegularizedTriangulationModel(models.BaseModel):
 
         num_frames = tf.cast(tf.expand_dims(num_frames, 1), tf.float32)
         model_input = utils.SampleRandomFrames(model_input, num_frames,
-                                               iterations)
+                                               iterations,
+                                               reader_sampling=unused_params.get("reader_sampling"))
 
         # model_input: batch_size x max_frames x feature_size
         max_frames = model_input.get_shape().as_list()[1]
@@ -1336,7 +1345,8 @@ class WeightedTriangulationModel(models.BaseModel):
         if random_frames:
             num_frames_2 = tf.cast(tf.expand_dims(num_frames, 1), tf.float32)
             model_input = utils.SampleRandomFrames(model_input, num_frames_2,
-                                                   iterations)
+                                                   iterations,
+                                                   reader_sampling=unused_params.get("reader_sampling"))
 
         # model_input: batch_size x max_frames x feature_size
         max_frames = model_input.get_shape().as_list()[1]
@@ -1528,7 +1538,8 @@ class TriangulationRelationalModel(models.BaseModel):
         if random_frames:
             num_frames_2 = tf.cast(tf.expand_dims(num_frames, 1), tf.float32)
             model_input = utils.SampleRandomFrames(model_input, num_frames_2,
-                                                   iterations)
+                                                   iterations,
+                                                   reader_sampling=unused_params.get("reader_sampling"))
 
         # model_input: batch_size x max_frames x feature_size
         max_frames = model_input.get_shape().as_list()[1]
@@ -1675,11 +1686,13 @@ class TembedModelV1(models.BaseModel):
         if random_frames:
             model_input = utils.SampleRandomFrames(model_input,
                                                    num_frames,
-                                                   iterations)
+                                                   iterations,
+                                                   reader_sampling=unused_params.get("reader_sampling"))
         else:
             model_input = utils.SampleRandomSequence(model_input,
                                                      num_frames,
-                                                     iterations)
+                                                     iterations,
+                                                     reader_sampling=unused_params.get("reader_sampling"))
 
         # model_input: batch_size x max_frames x feature_size
         max_frames = model_input.get_shape().as_list()[1]
@@ -1854,10 +1867,12 @@ class TembedModelV2(models.BaseModel):
         num_frames = tf.cast(tf.expand_dims(num_frames, 1), tf.float32)
         if random_frames:
             model_input = utils.SampleRandomFrames(model_input, num_frames,
-                                                   iterations)
+                                                   iterations,
+                                                   reader_sampling=unused_params.get("reader_sampling"))
         else:
             model_input = utils.SampleRandomSequence(model_input, num_frames,
-                                                     iterations)
+                                                     iterations,
+                                                     reader_sampling=unused_params.get("reader_sampling"))
 
         # model_input: batch_size x max_frames x feature_size
         max_frames = model_input.get_shape().as_list()[1]
@@ -2252,7 +2267,8 @@ class NetVladV1(models.BaseModel):
         # else:
         #     model_input = utils.SampleRandomSequence(model_input, num_frames,
         #                                              iterations)
-        model_input = utils.SampleUniformFrames(model_input, num_frames, iterations) # batch x frames x feature_size
+        model_input = utils.SampleUniformFrames(model_input, num_frames, iterations,
+                                                reader_sampling=unused_params.get("reader_sampling")) # batch x frames x feature_size
 
         max_frames      = model_input.get_shape().as_list()[1]
         feature_size    = model_input.get_shape().as_list()[2]                      # (batch * frames) x feature_size
@@ -2413,7 +2429,8 @@ class NetVladV2(models.BaseModel):
         # else:
         #     model_input = utils.SampleRandomSequence(model_input, num_frames,
         #                                              iterations)
-        model_input = utils.SampleUniformFrames(model_input, num_frames, iterations) # batch x frames x feature_size
+        model_input = utils.SampleUniformFrames(model_input, num_frames, iterations,
+                                                reader_sampling=unused_params.get("reader_sampling")) # batch x frames x feature_size
 
         max_frames      = model_input.get_shape().as_list()[1]
         feature_size    = model_input.get_shape().as_list()[2]                      # (batch * frames) x feature_size
@@ -2538,10 +2555,12 @@ class WillowModelReg(models.BaseModel):
         num_frames = tf.cast(tf.expand_dims(num_frames, 1), tf.float32)
         if random_frames:
             model_input = utils.SampleRandomFrames(model_input, num_frames,
-                                                   iterations)
+                                                   iterations,
+                                                   reader_sampling=unused_params.get("reader_sampling"))
         else:
             model_input = utils.SampleRandomSequence(model_input, num_frames,
-                                                     iterations)
+                                                     iterations,
+                                                     reader_sampling=unused_params.get("reader_sampling"))
 
         # model_input: batch_size x max_frames x feature_size
         max_frames = model_input.get_shape().as_list()[1]
@@ -2666,7 +2685,8 @@ class NetVLADModelLF(models.BaseModel):
 
         num_frames = tf.cast(tf.expand_dims(num_frames, 1), tf.float32)
         model_input = utils.SampleRandomFrames(model_input, num_frames,
-                                               iterations)
+                                               iterations,
+                                               reader_sampling=unused_params.get("reader_sampling"))
 
         max_frames = model_input.get_shape().as_list()[1]
         feature_size = model_input.get_shape().as_list()[2]
@@ -23,24 +23,31 @@ sys.path.append(os.path.join(os.getcwd(), "modules"))
 # noinspection PyUnresolvedReferences
 import pathmagic
 import os
-import glob
 import json
+import multiprocessing
 import tarfile
+import threading
 import time
 import sys
-import numpy
 import tensorflow as tf
+from tensorflow.python.framework import meta_graph
+from tensorflow.python.framework import op_def_registry
 from tensorflow.python.lib.io import file_io
 from tensorflow import app
 from tensorflow import flags
 from tensorflow import gfile
 from tensorflow import logging
 
-import eval_util
-import losses
+import compact_predictions
+import input_utils
 import readers
 import utils
 
+try:
+    import queue            # Python 3
+except ImportError:
+    import Queue as queue   # Python 2
+
 
 FLAGS = flags.FLAGS
 
@@ -76,6 +83,11 @@ if __name__ == '__main__':
                         "top 10 participants.")
     flags.DEFINE_integer("top_k", 20,
                          "How many predictions to output per video.")
+    flags.DEFINE_string("output_compact_dir", "",
+                        "If given, the top_k predictions are also written to "
+                        "this local directory as memory-mappable int16 class "
+                        "indices and float16 scores. compact_predictions.py "
+                        "converts it to the CSV format.")
 
     # Other flags.
     flags.DEFINE_integer(
@@ -83,17 +95,16 @@ if __name__ == '__main__':
         "How many examples to process per batch.")
     flags.DEFINE_integer("num_readers", 1,
                          "How many threads to use for reading input files.")
+    flags.DEFINE_integer("num_writer_processes", 0,
+                         "If positive, how many processes format the output "
+                         "lines. Otherwise a single background thread does.")
 
 
-def format_lines(video_ids, predictions, top_k):
-    batch_size = len(video_ids)
-    for video_index in range(batch_size):
-        top_indices = numpy.argpartition(predictions[video_index], -top_k)[-top_k:]
-        line = [(class_index, predictions[video_index][class_index])
-                for class_index in top_indices]
-        line = sorted(line, key=lambda p: -p[1])
-        yield video_ids[video_index].decode('utf-8') + "," + " ".join(
-            "%i %g" % (label, score) for (label, score) in line) + "\n"
+def format_batch(video_ids, top_indices, top_scores):
+    """Returns the CSV lines of the sorted top-k predictions of a batch as a
+    single string."""
+    return "".join(compact_predictions.format_top_k_lines(
+        video_ids, top_indices, top_scores))
 
 
 def get_input_data_tensors(reader, data_pattern, batch_size, num_readers=1):
@@ -113,52 +124,173 @@ def get_input_data_tensors(reader, data_pattern, batch_size, num_readers=1):
       Raises:
         IOError: If no files matching the given pattern were found.
     """
-    with tf.name_scope("input"):
-        files = gfile.Glob(data_pattern)
+    with tf.name_scope("inference_input"):
+        files = input_utils.get_files(data_pattern)
         if not files:
             raise IOError("Unable to find input files. data_pattern='" +
                           data_pattern + "'")
         logging.info("number of input files: " + str(len(files)))
-        filename_queue = tf.train.string_input_producer(
-            files, num_epochs=1, shuffle=False)
-        examples_and_labels = [reader.prepare_reader(filename_queue)
-                               for _ in range(num_readers)]
-
         video_id_batch, video_batch, unused_labels, num_frames_batch = (
-            tf.train.batch_join(examples_and_labels,
-                                batch_size=batch_size,
-                                allow_smaller_final_batch=True,
-                                enqueue_many=True))
+            input_utils.get_input_tensors(reader,
+                                          files,
+                                          batch_size=batch_size,
+                                          num_epochs=1,
+                                          num_readers=num_readers))
         return video_id_batch, video_batch, num_frames_batch
 
 
-def inference(reader, train_dir, data_pattern, out_file_location, batch_size, top_k):
-    with tf.Session(config=tf.ConfigProto(allow_soft_placement=True)) as sess, gfile.Open(out_file_location,
-                                                                                          "w+") as out_file:
-        video_id_batch, video_batch, num_frames_batch = get_input_data_tensors(reader, data_pattern, batch_size)
-        checkpoint_file = os.path.join(FLAGS.train_dir, "inference_model")
-        if not gfile.Exists(checkpoint_file + ".meta"):
-            raise IOError("Cannot find %s. Did you run eval.py?" % checkpoint_file)
-        meta_graph_location = checkpoint_file + ".meta"
-        logging.info("loading meta-graph: " + meta_graph_location)
-
-        if FLAGS.output_model_tgz:
-            out_file_tgz = file_io.FileIO(FLAGS.output_model_tgz, "w")
-            with tarfile.open(fileobj=out_file_tgz, mode="w:gz") as tar:
-                for model_file in file_io.get_matching_files(checkpoint_file + '.*'):
-                    # tar.addfile(file_io.FileIO(model_file, "r"), arcname=os.path.basename(model_file))
-                    tar.addfile(file_io.FileIO(model_file, "r"))
-                # tar.add(os.path.join(FLAGS.train_dir, "model_flags.json"),
-                #         arcname="model_flags.json")
-                tar.addfile(file_io.FileIO(os.path.join(FLAGS.train_dir, "model_flags.json"), "r"))
-            print('Tarred model onto ' + FLAGS.output_model_tgz)
+class BatchWriter(object):
+    """Formats and writes the top-k predictions in a background thread.
+
+    The queue holds at most max_pending batches, so that the writer
+    overlaps the compute of the next batches without lagging behind. If a
+    process pool is given, the batches are formatted in parallel by its
+    processes and written in order. If a CompactPredictionWriter is given,
+    the predictions are also written to it.
+    """
+
+    def __init__(self, out_file, max_pending=2, pool=None,
+                 compact_writer=None):
+        self.out_file = out_file
+        self.pool = pool
+        self.compact_writer = compact_writer
+        self.error = None
+        self._batches = queue.Queue(max_pending)
+        self._thread = threading.Thread(target=self._write_batches)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _write_batches(self):
+        while True:
+            batch = self._batches.get()
+            if batch is None:
+                return
+            if self.error:
+                continue
+            try:
+                video_ids, top_indices, top_scores, formatted_lines = batch
+                if self.pool:
+                    lines = formatted_lines.get()
+                else:
+                    lines = format_batch(video_ids, top_indices, top_scores)
+                self.out_file.write(lines)
+                self.out_file.flush()
+                if self.compact_writer:
+                    self.compact_writer.write(video_ids, top_indices, top_scores)
+            except Exception as e:
+                # Keeps consuming the batches so that put never blocks.
+                self.error = e
+
+    def put(self, video_ids, top_indices, top_scores):
+        """Queues a batch of predictions to be written.
+
+        Args:
+          video_ids: the video ids, as bytes.
+          top_indices: the 'batch' x top_k class indices, by decreasing score.
+          top_scores: the 'batch' x top_k scores.
+        """
+        if self.error:
+            raise self.error
+        formatted_lines = None
+        if self.pool:
+            # Only the top-k predictions are sent to the worker processes.
+            formatted_lines = self.pool.apply_async(
+                format_batch, (video_ids, top_indices, top_scores))
+        self._batches.put((video_ids, top_indices, top_scores, formatted_lines))
+
+    def close(self):
+        """Waits for the queued batches to be written."""
+        self._batches.put(None)
+        self._thread.join()
+        if self.compact_writer and not self.error:
+            self.compact_writer.close()
+        if self.error:
+            raise self.error
+
+
+def get_input_dtype(meta_graph_def):
+    """Returns the dtype of the input_batch_raw tensor of a meta graph.
+
+    The dtype is read from the node of the tensor in the GraphDef and the
+    definition of its op, without importing the graph.
+    """
+    tensor_name = meta_graph_def.collection_def["input_batch_raw"].node_list.value[0]
+    node_name, _, output_index = tensor_name.rpartition(":")
+    node = [node for node in meta_graph_def.graph_def.node
+            if node.name == node_name][0]
+    op_def = op_def_registry.get_registered_ops()[node.op]
+    attr_defaults = {attr.name: attr.default_value for attr in op_def.attr}
+
+    def get_attr(name):
+        return node.attr[name] if name in node.attr else attr_defaults[name]
+
+    output_types = []
+    for output_arg in op_def.output_arg:
+        if output_arg.type_list_attr:
+            output_types.extend(get_attr(output_arg.type_list_attr).list.type)
+        else:
+            dtype = (get_attr(output_arg.type_attr).type if output_arg.type_attr
+                     else output_arg.type)
+            count = get_attr(output_arg.number_attr).i if output_arg.number_attr else 1
+            output_types.extend([dtype] * count)
+    return tf.as_dtype(output_types[int(output_index)])
+
+
+def inference(reader, train_dir, data_pattern, out_file_location, batch_size, top_k,
+              num_readers=1, num_writer_processes=0, compact_output_dir=None):
+    checkpoint_file = os.path.join(train_dir, "inference_model")
+    if not gfile.Exists(checkpoint_file + ".meta"):
+        raise IOError("Cannot find %s. Did you run eval.py?" % checkpoint_file)
+    meta_graph_location = checkpoint_file + ".meta"
+    logging.info("loading meta-graph: " + meta_graph_location)
+
+    if FLAGS.output_model_tgz:
+        out_file_tgz = file_io.FileIO(FLAGS.output_model_tgz, "w")
+        with tarfile.open(fileobj=out_file_tgz, mode="w:gz") as tar:
+            for model_file in file_io.get_matching_files(checkpoint_file + '.*'):
+                # tar.addfile(file_io.FileIO(model_file, "r"), arcname=os.path.basename(model_file))
+                tar.addfile(file_io.FileIO(model_file, "r"))
+            # tar.add(os.path.join(FLAGS.train_dir, "model_flags.json"),
+            #         arcname="model_flags.json")
+            tar.addfile(file_io.FileIO(os.path.join(train_dir, "model_flags.json"), "r"))
+        print('Tarred model onto ' + FLAGS.output_model_tgz)
+
+    meta_graph_def = meta_graph.read_meta_graph_file(meta_graph_location)
+    collections = meta_graph_def.collection_def
+    input_tensor_name = collections["input_batch_raw"].node_list.value[0]
+    num_frames_tensor_name = collections["num_frames"].node_list.value[0]
+
+    # Feeds the frames quantized if the model graph dequantizes them.
+    if isinstance(reader, readers.YT8MFrameFeatureReader):
+        reader.dequantize = get_input_dtype(meta_graph_def) != tf.uint8
+
+    # The processes are forked before the session starts its threads.
+    pool = None
+    if num_writer_processes > 0:
+        pool = multiprocessing.Pool(num_writer_processes)
+        max_pending = 2 * num_writer_processes
+    else:
+        max_pending = 2
+
+    with tf.Graph().as_default(), tf.Session(
+            config=tf.ConfigProto(allow_soft_placement=True)) as sess, gfile.Open(
+            out_file_location, "w+") as out_file:
+        video_id_batch, video_batch, num_frames_batch = get_input_data_tensors(
+            reader, data_pattern, batch_size, num_readers)
+
+        # The reader output replaces the input of the restored graph, so the
+        # batches never go through Python.
         with tf.device("/gpu:0"):
-            saver = tf.train.import_meta_graph(meta_graph_location, clear_devices=True)
+            saver = tf.train.import_meta_graph(
+                meta_graph_def, clear_devices=True,
+                input_map={input_tensor_name: video_batch,
+                           num_frames_tensor_name: num_frames_batch})
         logging.info("restoring variables from " + checkpoint_file)
         saver.restore(sess, checkpoint_file)
-        input_tensor = tf.get_collection("input_batch_raw")[0]
-        num_frames_tensor = tf.get_collection("num_frames")[0]
         predictions_tensor = tf.get_collection("predictions")[0]
+        # Only the top_k predictions of every video leave the graph.
+        top_scores_tensor, top_indices_tensor = tf.nn.top_k(predictions_tensor,
+                                                            top_k)
 
         # Workaround for num_epochs issue.
         def set_up_init_ops(variables):
@@ -170,40 +302,36 @@ def inference(reader, train_dir, data_pattern, out_file_location, batch_size, to
             init_op_list.append(tf.variables_initializer(variables))
             return init_op_list
 
-        # tf.get_default_graph().clear_collection("queue_runners")
-        # tf.get_default_graph().clear_collection("local_variables")
         sess.run(set_up_init_ops(tf.get_collection_ref(
             tf.GraphKeys.LOCAL_VARIABLES)))
 
-        coord = tf.train.Coordinator()
-        threads = tf.train.start_queue_runners(sess=sess, coord=coord)
         num_examples_processed = 0
         start_time = time.time()
-        out_file.write("VideoId,LabelConfidencePairs\n")
+        out_file.write(compact_predictions.CSV_HEADER)
+        compact_writer = None
+        if compact_output_dir:
+            compact_writer = compact_predictions.CompactPredictionWriter(
+                compact_output_dir, top_k)
+        writer = BatchWriter(out_file, max_pending, pool, compact_writer)
 
         try:
-            while not coord.should_stop():
-                video_id_batch_val, video_batch_val, num_frames_batch_val = sess.run(
-                    [video_id_batch, video_batch, num_frames_batch])
-                predictions_val, = sess.run([predictions_tensor], feed_dict={input_tensor: video_batch_val,
-                                                                             num_frames_tensor: num_frames_batch_val})
+            while True:
+                video_id_batch_val, top_indices_val, top_scores_val = sess.run(
+                    [video_id_batch, top_indices_tensor, top_scores_tensor])
+                writer.put(video_id_batch_val, top_indices_val, top_scores_val)
                 now = time.time()
-                num_examples_processed += len(video_batch_val)
-                num_classes = predictions_val.shape[1]
+                num_examples_processed += len(video_id_batch_val)
                 logging.info(
                     "num examples processed: " + str(num_examples_processed) + " elapsed seconds: " + "{0:.2f}".format(
-                        now - start_time))
-                for line in format_lines(video_id_batch_val, predictions_val, top_k):
-                    out_file.write(line)
-                out_file.flush()
+                        now - start_time) + " videos/sec: " + "{0:.2f}".format(
+                        num_examples_processed / (now - start_time)))
 
         except tf.errors.OutOfRangeError:
             logging.info('Done with inference. The output file was written to ' + out_file_location)
         finally:
-            coord.request_stop()
-
-        coord.join(threads)
-        sess.close()
+            writer.close()
+            if pool:
+                pool.close()
 
 
 def main(unused_argv):
@@ -243,7 +371,9 @@ def main(unused_argv):
                          "Unable to continue with inference.")
 
     inference(reader, FLAGS.train_dir, FLAGS.input_data_pattern,
-              FLAGS.output_file, FLAGS.batch_size, FLAGS.top_k)
+              FLAGS.output_file, FLAGS.batch_size, FLAGS.top_k,
+              FLAGS.num_readers, FLAGS.num_writer_processes,
+              FLAGS.output_compact_dir)
 
 
 if __name__ == "__main__":
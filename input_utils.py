@@ -0,0 +1,310 @@
+# Copyright 2018 Deep Topology All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Provides the tf.data input pipeline shared by training, evaluation and
+inference."""
+# noinspection PyUnresolvedReferences
+import pathmagic
+import atexit
+import collections
+import os
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
+import numpy
+import tensorflow as tf
+from tensorflow import gfile
+from tensorflow import logging
+
+import frame_cache
+import utils
+
+# The initializers of the initializable input iterators, which restart the
+# input pipeline from the beginning of the data.
+INPUT_INITIALIZERS = "input_initializers"
+
+
+def get_files(data_pattern, num_shards=1, shard_index=0):
+    """Lists the files of a shard of the data set.
+
+      Args:
+        data_pattern: Comma separated 'glob' style paths to the data files.
+        num_shards: How many shards the files are split into.
+        shard_index: Which shard to return, in [0, num_shards).
+
+      Returns:
+        The sorted list of the files of the shard. File i belongs to shard
+        i % num_shards, so that every file is assigned to exactly one shard.
+    """
+    patterns = [pattern.strip() for pattern in data_pattern.split(",")]
+    if len(patterns) > 1:
+        # Remote globs are slow, so they are listed concurrently.
+        pool = ThreadPool(len(patterns))
+        matches = pool.map(gfile.Glob, patterns)
+        pool.close()
+    else:
+        matches = [gfile.Glob(patterns[0])]
+    files = [path for paths in matches for path in paths]
+    return sorted(files)[shard_index::num_shards]
+
+
+class FilePrefetcher(object):
+    """Copies (remote) files into a bounded local cache ahead of their use.
+
+    The files are copied by a pool of background threads, at most
+    num_prefetch files ahead of the reader, and a local copy is deleted once
+    num_keep newer copies were handed out. The reader keeps reading the files
+    it has open, since they are only unlinked.
+    """
+
+    def __init__(self, cache_dir, num_prefetch=4, num_keep=8, num_threads=4):
+        """Construct a FilePrefetcher.
+
+        Args:
+          cache_dir: the local directory to copy the files into, e.g. on a
+            local disk, or under /dev/shm to keep them in memory. The copies
+            are written in a new subdirectory, removed at exit.
+          num_prefetch: how many files to copy ahead of the reader.
+          num_keep: how many of the files handed out to keep. It should be
+            larger than the number of files read in parallel.
+          num_threads: how many files to copy at the same time.
+        """
+        if not gfile.Exists(cache_dir):
+            gfile.MakeDirs(cache_dir)
+        self.cache_dir = tempfile.mkdtemp(prefix="prefetch_", dir=cache_dir)
+        atexit.register(shutil.rmtree, self.cache_dir, True)
+        self.num_prefetch = num_prefetch
+        self.num_keep = num_keep
+        self._pool = ThreadPool(num_threads)
+
+    def _copy(self, path, local_path):
+        temporary_path = local_path + ".tmp"
+        gfile.Copy(path, temporary_path, overwrite=True)
+        gfile.Rename(temporary_path, local_path, overwrite=True)
+        return local_path
+
+    def _next_local_file(self, pending, handed_out):
+        local_path = pending.popleft().get()
+        handed_out.append(local_path)
+        while len(handed_out) > self.num_keep:
+            gfile.Remove(handed_out.popleft())
+        return local_path
+
+    def local_files(self, files):
+        """Yields the paths of the local copies of the files, in order.
+
+        Args:
+          files: an iterable of file paths, possibly repeated.
+        """
+        pending = collections.deque()
+        handed_out = collections.deque()
+        for index, path in enumerate(files):
+            local_path = os.path.join(
+                self.cache_dir, "%d_%s" % (index, os.path.basename(path)))
+            pending.append(self._pool.apply_async(self._copy, (path, local_path)))
+            if len(pending) > self.num_prefetch:
+                yield self._next_local_file(pending, handed_out)
+        while pending:
+            yield self._next_local_file(pending, handed_out)
+
+
+def num_open_files(num_readers):
+    """How many files get_input_tensors opens at once with num_readers.
+
+    The files are interleaved by num_readers readers, which open as many
+    files again ahead of them.
+    """
+    return num_readers + _prefetch_input_elements(num_readers)
+
+
+def _prefetch_input_elements(num_readers):
+    """How many files the interleaved readers open ahead of them."""
+    return num_readers
+
+
+def _epoch_files(files, num_epochs, shuffle, seed):
+    """Yields the files of every epoch, shuffled if requested."""
+    random_state = numpy.random.RandomState(seed)
+    epoch = 0
+    while num_epochs is None or epoch < num_epochs:
+        for path in (random_state.permutation(files) if shuffle else files):
+            yield path
+        epoch += 1
+
+
+def _trim_padding_frames(video_id, video_matrix, labels, num_frames):
+    """Removes the padding of a single video, to be padded again per bucket."""
+    return video_id, video_matrix[:num_frames], labels, num_frames
+
+
+def get_input_tensors(reader,
+                      files,
+                      batch_size,
+                      num_epochs=None,
+                      shuffle=False,
+                      num_readers=1,
+                      shuffle_buffer_size=None,
+                      seed=None,
+                      bucket_boundaries=None,
+                      prefetcher=None,
+                      initializable=False):
+    """Creates a tf.data pipeline which reads, parses and batches the data.
+
+      The files are read in parallel by interleaving num_readers of them, the
+      records are parsed by the reader with autotuned parallelism and the
+      batches are prefetched.
+
+      Args:
+        reader: A class which parses the data. It should inherit from
+                BaseReader.
+        files: A list of TFRecord files.
+        batch_size: How many examples to process at a time. The last batch is
+                    smaller if the data set size is not a multiple of it.
+        num_epochs: How many passes to make over the data. 'None' means an
+                    unlimited number of passes.
+        shuffle: Whether to shuffle the files and the examples.
+        num_readers: How many files to read in parallel.
+        shuffle_buffer_size: How many examples the shuffle buffer holds.
+                             Defaults to 5 * batch_size.
+        seed: Seed of the file and example shuffling.
+        bucket_boundaries: If set, a list of increasing numbers of frames. The
+                           videos of a frame-level reader are then batched
+                           with videos of the same bucket of num_frames, and
+                           every batch is only padded to its longest video,
+                           so the frame dimension of the features is dynamic.
+        prefetcher: If set, a FilePrefetcher which copies the files locally
+                    before they are read. It should keep at least
+                    num_open_files(num_readers) of them.
+        initializable: Whether the iterator can be restarted. Its initializer
+                       is then added to the INPUT_INITIALIZERS collection and
+                       must be run before reading the data.
+
+      Returns:
+        A tuple of the video ids, features, labels and number of frames batch
+        tensors. The exact dimensions depend on the reader being used.
+    """
+    autotune = tf.contrib.data.AUTOTUNE
+    if prefetcher:
+        dataset = tf.data.Dataset.from_generator(
+            lambda: prefetcher.local_files(
+                _epoch_files(files, num_epochs, shuffle, seed)),
+            tf.string, tf.TensorShape([]))
+    else:
+        dataset = tf.data.Dataset.from_tensor_slices(files)
+        if shuffle:
+            dataset = dataset.shuffle(len(files), seed=seed)
+        dataset = dataset.repeat(num_epochs)
+    dataset = dataset.apply(tf.contrib.data.parallel_interleave(
+        tf.data.TFRecordDataset, cycle_length=num_readers, sloppy=shuffle,
+        prefetch_input_elements=_prefetch_input_elements(num_readers)))
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer_size or 5 * batch_size,
+                                  seed=seed)
+
+    # The readers parse whole batches of serialized examples at once.
+    dataset = dataset.batch(batch_size)
+    if bucket_boundaries:
+        dataset = dataset.map(
+            lambda examples: reader.prepare_serialized_examples(
+                examples, pad_to_max_frames=False),
+            num_parallel_calls=autotune)
+        dataset = dataset.apply(tf.contrib.data.unbatch())
+        dataset = dataset.map(_trim_padding_frames,
+                              num_parallel_calls=autotune)
+        dataset = dataset.apply(tf.contrib.data.bucket_by_sequence_length(
+            lambda video_id, video_matrix, labels, num_frames: num_frames,
+            bucket_boundaries,
+            [batch_size] * (len(bucket_boundaries) + 1)))
+    else:
+        dataset = dataset.map(reader.prepare_serialized_examples,
+                              num_parallel_calls=autotune)
+    dataset = dataset.prefetch(autotune)
+
+    logging.info("Reading %d files with %d parallel readers.", len(files),
+                 num_readers)
+    if initializable:
+        iterator = dataset.make_initializable_iterator()
+        tf.add_to_collection(INPUT_INITIALIZERS, iterator.initializer)
+    else:
+        iterator = dataset.make_one_shot_iterator()
+    return iterator.get_next()
+
+
+def get_frame_cache_input_tensors(reader,
+                                  cache_dir,
+                                  batch_size,
+                                  num_epochs=None,
+                                  shuffle=False,
+                                  num_shards=1,
+                                  shard_index=0,
+                                  seed=None):
+    """Creates a tf.data pipeline which reads batches from a frame cache.
+
+      The batches are gathered from the memory-mapped cache written by
+      frame_cache.py as uint8 frames, and dequantized by the input graph
+      unless the reader keeps the features quantized.
+
+      Args:
+        reader: The YT8MFrameFeatureReader whose features, number of classes
+                and max_frames are used.
+        cache_dir: The frame cache directory.
+        batch_size: How many examples to process at a time.
+        num_epochs: How many passes to make over the data. 'None' means an
+                    unlimited number of passes.
+        shuffle: Whether to shuffle the videos at every epoch.
+        num_shards: How many shards the videos are split into.
+        shard_index: Which shard to read, in [0, num_shards).
+        seed: Seed of the video shuffling.
+
+      Returns:
+        A tuple of the video ids, features, labels and number of frames batch
+        tensors, the same as for the reader.
+    """
+    cache = frame_cache.FrameCache(cache_dir)
+    videos = numpy.arange(shard_index, cache.num_videos, num_shards)
+    feature_size = sum(reader.feature_sizes)
+
+    def generate_batches():
+        random_state = numpy.random.RandomState(seed)
+        epoch = 0
+        while num_epochs is None or epoch < num_epochs:
+            order = random_state.permutation(videos) if shuffle else videos
+            for start in range(0, order.size, batch_size):
+                yield cache.get_batch(order[start:start + batch_size],
+                                      reader.feature_names, reader.max_frames,
+                                      reader.num_classes)
+            epoch += 1
+
+    def dequantize(video_ids, frames, labels, num_frames):
+        video_matrix = utils.Dequantize(tf.cast(frames, tf.float32))
+        # Keeps the padding frames at zero, as the TFRecord reader does.
+        mask = tf.sequence_mask(num_frames, reader.max_frames, dtype=tf.float32)
+        return (video_ids, video_matrix * tf.expand_dims(mask, 2), labels,
+                num_frames)
+
+    dataset = tf.data.Dataset.from_generator(
+        generate_batches,
+        (tf.string, tf.uint8, tf.bool, tf.int32),
+        (tf.TensorShape([None]),
+         tf.TensorShape([None, reader.max_frames, feature_size]),
+         tf.TensorShape([None, reader.num_classes]),
+         tf.TensorShape([None])))
+    if reader.dequantize:
+        dataset = dataset.map(dequantize,
+                              num_parallel_calls=tf.contrib.data.AUTOTUNE)
+    dataset = dataset.prefetch(tf.contrib.data.AUTOTUNE)
+
+    logging.info("Reading %d videos from the frame cache %s.", videos.size,
+                 cache_dir)
+    return dataset.make_one_shot_iterator().get_next()
@@ -44,30 +44,40 @@ import average_precision_calculator
 
 class MeanAveragePrecisionCalculator(object):
     """This class is to calculate mean average precision.
+
+    The (class, prediction, label) triplets of all the classes are stored in
+    flat arrays, in arrival order, so that the memory is proportional to the
+    number of triplets and merging a batch is a single append. They are only
+    grouped by class when the average precisions are computed.
     """
 
+    # Initial number of slots in the growable triplet buffers.
+    _INITIAL_CAPACITY = 1024
+
     def __init__(self, num_class):
         """Construct a calculator to calculate the (macro) average precision.
 
         Args:
           num_class: A positive Integer specifying the number of classes.
-          top_n_array: A list of positive integers specifying the top n for each
-          class. The top n in each class will be used to calculate its average
-          precision at n.
-          The size of the array must be num_class.
 
         Raises:
-          ValueError: An error occurred when num_class is not a positive integer;
-          or the top_n_array is not a list of positive integers.
+          ValueError: An error occurred when num_class is not a positive integer.
         """
         if not isinstance(num_class, int) or num_class <= 1:
             raise ValueError("num_class must be a positive integer.")
 
-        self._ap_calculators = []  # member of AveragePrecisionCalculator
         self._num_class = num_class  # total number of classes
-        for i in range(num_class):
-            self._ap_calculators.append(
-                average_precision_calculator.AveragePrecisionCalculator())
+        self._class_indices = numpy.empty(0, dtype=numpy.int32)
+        self._predictions = numpy.empty(0, dtype=numpy.float32)
+        self._actuals = numpy.empty(0, dtype=numpy.bool_)
+        self._size = 0  # number of valid entries in the buffers
+        self._sizes = numpy.zeros(num_class, dtype=numpy.int64)
+        self._total_positives = self._no_positives()
+
+    def _no_positives(self):
+        # The smallest type, so that the sums take the type of the first counts,
+        # as the 0 of AveragePrecisionCalculator does.
+        return numpy.zeros(self._num_class, dtype=numpy.int8)
 
     def accumulate(self, predictions, actuals, num_positives=None):
         """Accumulate the predictions and their ground truth labels.
@@ -86,28 +96,210 @@ class MeanAveragePrecisionCalculator(object):
           ValueError: An error occurred when the shape of predictions and actuals
           does not match.
         """
-        if not num_positives:
-            num_positives = [None for i in predictions.shape[1]]
+        if len(predictions) != self._num_class or len(actuals) != self._num_class:
+            raise ValueError("the outer dimension of predictions and actuals must "
+                             "be num_class.")
+        lengths = [len(class_predictions) for class_predictions in predictions]
+        if lengths != [len(class_actuals) for class_actuals in actuals]:
+            raise ValueError("the shape of predictions and actuals does not match.")
+
+        class_indices = numpy.repeat(numpy.arange(self._num_class), lengths)
+        if class_indices.size:
+            predictions = numpy.concatenate(
+                [numpy.asarray(p).reshape(-1) for p in predictions if len(p)])
+            actuals = numpy.concatenate(
+                [numpy.asarray(a).reshape(-1) for a in actuals if len(a)])
+        else:
+            predictions = numpy.empty(0, dtype=numpy.float32)
+            actuals = numpy.empty(0, dtype=numpy.bool_)
+        self.accumulate_triplets(class_indices, predictions, actuals, num_positives)
+
+    def accumulate_triplets(self, class_indices, predictions, actuals,
+                            num_positives=None):
+        """Accumulate flat (class, prediction, label) triplets.
+
+        Entries of the same class are appended in the order they are given.
+
+        Args:
+          class_indices: A 1-D array with the class of every entry.
+          predictions: A 1-D array with the prediction score of every entry.
+          actuals: A 1-D array with the ground truth label of every entry. Any
+          value larger than 0 will be treated as positives, otherwise as
+          negatives.
+          num_positives: If provided, an array of size num_class with the number
+          of true positives for each class. If not provided, the number of true
+          positives will be inferred from the 'actuals' array.
+
+        Raises:
+          ValueError: An error occurred when the shapes of the inputs do not
+          match.
+        """
+        class_indices = numpy.asarray(class_indices, dtype=numpy.int64).reshape(-1)
+        predictions = numpy.asarray(predictions).reshape(-1)
+        actuals = numpy.asarray(actuals).reshape(-1)
+        if not class_indices.size == predictions.size == actuals.size:
+            raise ValueError("the shape of predictions and actuals does not match.")
+
+        if num_positives is None:
+            num_positives = numpy.bincount(class_indices[actuals > 0],
+                                           minlength=self._num_class)
+        else:
+            num_positives = numpy.asarray(num_positives)
+            if num_positives.shape != (self._num_class,):
+                raise ValueError("num_positives must have num_class entries.")
+
+        counts = numpy.bincount(class_indices, minlength=self._num_class)
+        if counts.size != self._num_class or num_positives.size != self._num_class:
+            raise ValueError("class_indices must be in [0, num_class).")
+        self._total_positives = self._total_positives + num_positives
+
+        if not class_indices.size:
+            return
+        self._append(class_indices, predictions, actuals)
+        self._sizes += counts
+
+    def _append(self, class_indices, predictions, actuals):
+        """Appends triplets to the buffers, growing them geometrically."""
+        required = self._size + class_indices.size
+        prediction_dtype = numpy.promote_types(self._predictions.dtype,
+                                               predictions.dtype)
+        actual_dtype = numpy.promote_types(self._actuals.dtype, actuals.dtype)
+        if (required > self._predictions.size or
+                prediction_dtype != self._predictions.dtype or
+                actual_dtype != self._actuals.dtype):
+            capacity = max(self._INITIAL_CAPACITY, self._predictions.size)
+            while capacity < required:
+                capacity *= 2
+            self._class_indices = self._grow(self._class_indices, capacity,
+                                             self._class_indices.dtype)
+            self._predictions = self._grow(self._predictions, capacity,
+                                           prediction_dtype)
+            self._actuals = self._grow(self._actuals, capacity, actual_dtype)
+
+        self._class_indices[self._size:required] = class_indices
+        self._predictions[self._size:required] = predictions
+        self._actuals[self._size:required] = actuals
+        self._size = required
+
+    def _grow(self, array, capacity, dtype):
+        grown = numpy.empty(capacity, dtype=dtype)
+        grown[:self._size] = array[:self._size]
+        return grown
+
+    def get_state(self):
+        """Gets the accumulated state as a dictionary of numpy values.
+
+        The state holds the flat (class, prediction, label) triplets in arrival
+        order, so its size is proportional to the number of accumulated
+        entries. It can be serialized (e.g. with numpy.savez) and merged into
+        another calculator with merge_state.
+        """
+        return {"class_indices": self._class_indices[:self._size].copy(),
+                "predictions": self._predictions[:self._size].copy(),
+                "actuals": self._actuals[:self._size].copy(),
+                "total_positives": self._total_positives.copy()}
+
+    def merge_state(self, state):
+        """Merges a state returned by get_state into this calculator.
 
-        calculators = self._ap_calculators
-        for i in range(len(predictions)):
-            calculators[i].accumulate(predictions[i], actuals[i], num_positives[i])
+        The merged entries of every class are appended after the ones already
+        accumulated, as if they had been passed to accumulate.
+
+        Raises:
+          ValueError: An error occurred when the state was computed with a
+            different num_class.
+        """
+        total_positives = numpy.asarray(state["total_positives"])
+        if total_positives.shape != (self._num_class,):
+            raise ValueError("Cannot merge a state computed for %d classes." %
+                             total_positives.size)
+        self.accumulate_triplets(state["class_indices"], state["predictions"],
+                                 state["actuals"], total_positives)
 
     def clear(self):
-        for calculator in self._ap_calculators:
-            calculator.clear()
+        """Clear the accumulated predictions, keeping the allocated storage."""
+        self._size = 0
+        self._sizes[:] = 0
+        self._total_positives = self._no_positives()
 
     def is_empty(self):
-        return ([calculator.heap_size for calculator in self._ap_calculators] ==
-                [0 for _ in range(self._num_class)])
+        return self._size == 0
 
     def peek_map_at_n(self):
         """Peek the non-interpolated mean average precision at n.
 
+        Gives the same results as AveragePrecisionCalculator.peek_ap_at_n on the
+        predictions of every class: each class is shuffled with the seeded
+        permutation of its size, sorted stably by descending score and its
+        precision terms are summed left to right.
+
         Returns:
           An array of non-interpolated average precision at n (default 0) for each
           class.
         """
-        aps = [self._ap_calculators[i].peek_ap_at_n()
-               for i in range(self._num_class)]
+        aps = [0] * self._num_class
+        size = self._size
+        if not size:
+            return aps
+        ap_calculator = average_precision_calculator.AveragePrecisionCalculator
+
+        # Group the entries by class, in arrival order.
+        order = numpy.argsort(self._class_indices[:size], kind="stable")
+        predictions = self._predictions[:size][order]
+        actuals = self._actuals[:size][order]
+        sizes = self._sizes
+        group_starts = numpy.cumsum(sizes) - sizes
+        classes = numpy.repeat(numpy.arange(self._num_class), sizes)
+
+        # Like AveragePrecisionCalculator, the classes where equal predictions
+        # have different labels are put in the order of a heap.
+        tie_order = numpy.lexsort((predictions, classes))
+        tied_classes = classes[tie_order]
+        tied_predictions = predictions[tie_order]
+        tied_hits = actuals[tie_order] > 0
+        mixed = ((tied_classes[1:] == tied_classes[:-1]) &
+                 (tied_predictions[1:] == tied_predictions[:-1]) &
+                 (tied_hits[1:] != tied_hits[:-1]))
+        for c in numpy.unique(tied_classes[1:][mixed]):
+            group = slice(group_starts[c], group_starts[c] + sizes[c])
+            predictions[group], actuals[group] = average_precision_calculator._heap_order(
+                predictions[group], actuals[group])
+
+        # Shuffle every class with the permutation of its size.
+        shuffle = numpy.empty(size, dtype=numpy.int64)
+        for class_size in numpy.unique(sizes[sizes > 0]):
+            starts = group_starts[sizes == class_size][:, None]
+            permutation = numpy.asarray(
+                ap_calculator._shuffle_indices(int(class_size)))
+            shuffle[(starts + numpy.arange(class_size)).reshape(-1)] = (
+                starts + permutation).reshape(-1)
+        predictions = predictions[shuffle]
+        actuals = actuals[shuffle]
+
+        # Stable descending sort within every class.
+        sortidx = numpy.lexsort((-predictions, classes))
+        ranks = numpy.arange(1, size + 1) - group_starts[classes]
+        hits = actuals[sortidx] > 0
+        poscount = numpy.cumsum(hits, dtype=numpy.int64)
+        poscount -= numpy.concatenate([[0], poscount])[group_starts][classes]
+
+        numpos = self._total_positives
+        hit_indices = numpy.flatnonzero(hits)
+        hit_classes = classes[hit_indices]
+        with numpy.errstate(divide="ignore"):
+            delta_recall = 1.0 / numpos
+        # The terms have the type of the ones of ap_at_n, e.g. float32 when the
+        # numbers of positives are.
+        dtype = delta_recall.dtype
+        terms = ((poscount[hit_indices] / ranks[hit_indices]).astype(dtype) *
+                 delta_recall[hit_classes])
+        # The terms of every class are summed left to right, as ap_at_n does.
+        bounds = numpy.searchsorted(hit_classes, numpy.arange(self._num_class + 1))
+        for c in numpy.flatnonzero(sizes):
+            if numpos[c] == 0:
+                continue
+            if bounds[c] == bounds[c + 1]:
+                aps[c] = 0.0
+            else:
+                aps[c] = numpy.cumsum(terms[bounds[c]:bounds[c + 1]], dtype=dtype)[-1]
         return aps
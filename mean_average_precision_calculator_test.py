@@ -0,0 +1,58 @@
+# Copyright 2018 Deep Topology All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares MeanAveragePrecisionCalculator with one heapq calculator per class."""
+
+import unittest
+
+import numpy
+
+import average_precision_calculator_test
+import mean_average_precision_calculator
+
+
+class MeanAveragePrecisionCalculatorTest(unittest.TestCase):
+
+    def test_tied_float32_predictions(self):
+        rng = numpy.random.RandomState(0)
+        num_class = 10
+        for levels in [4, 1000, None]:
+            calculator = mean_average_precision_calculator.MeanAveragePrecisionCalculator(
+                num_class)
+            chunks = [[] for _ in range(num_class)]
+            for _ in range(5):
+                predictions, actuals, num_positives = [], [], []
+                for c in range(num_class):
+                    size = rng.randint(0, 20)
+                    class_predictions = rng.rand(size).astype(numpy.float32)
+                    if levels:
+                        class_predictions = numpy.round(class_predictions * levels) / levels
+                    class_predictions = class_predictions.astype(numpy.float32)
+                    class_actuals = (rng.rand(size) < 0.3).astype(numpy.float32)
+                    predictions.append(class_predictions)
+                    actuals.append(class_actuals)
+                    num_positives.append(numpy.sum(class_actuals))
+                    chunks[c].append((class_predictions, class_actuals,
+                                      num_positives[-1]))
+                calculator.accumulate(predictions, actuals, num_positives)
+
+            expected = [average_precision_calculator_test.reference_ap(class_chunks, None)
+                        for class_chunks in chunks]
+            actual = calculator.peek_map_at_n()
+            self.assertEqual(expected, actual)
+            self.assertEqual([type(ap) for ap in expected], [type(ap) for ap in actual])
+
+
+if __name__ == "__main__":
+    unittest.main()
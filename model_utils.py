@@ -23,19 +23,28 @@ from tensorflow import flags
 import tensorflow.contrib.slim as slim
 
 
-def SampleRandomSequence(model_input, num_frames, num_samples):
-    """ Samples a random sequence of frames of size num_samples.
+def GatherFrames(model_input, frame_index):
+    """Gathers the batch_size x num_samples frames of frame_index."""
+    batch_size = tf.shape(frame_index)[0]
+    num_samples = tf.shape(frame_index)[1]
+    batch_index = tf.tile(
+        tf.expand_dims(tf.range(batch_size), 1), [1, num_samples])
+    index = tf.stack([batch_index, frame_index], 2)
+    return tf.gather_nd(model_input, index)
+
+
+def SampleRandomSequenceIndex(num_frames, num_samples):
+    """ Samples the indices of a random sequence of frames of size num_samples.
 
     Args:
-        model_input: A tensor of size batch_size x max_frames x feature_size
         num_frames: A tensor of size batch_size x 1
         num_samples: A scalar
 
     Returns:
-        `model_input`: A tensor of size batch_size x num_samples x feature_size
+        `frame_index`: An int32 tensor of size batch_size x num_samples
       """
 
-    batch_size = tf.shape(model_input)[0]
+    batch_size = tf.shape(num_frames)[0]
     frame_index_offset = tf.tile(
         tf.expand_dims(tf.range(num_samples), 0), [batch_size, 1])
     max_start_frame_index = tf.maximum(num_frames - num_samples, 0)
@@ -43,34 +52,67 @@ def SampleRandomSequence(model_input, num_frames, num_samples):
         tf.multiply(
             tf.random_uniform([batch_size, 1]),
             tf.cast(max_start_frame_index + 1, tf.float32)), tf.int32)
-    frame_index = tf.minimum(start_frame_index + frame_index_offset,
-                             tf.cast(num_frames - 1, tf.int32))
-    batch_index = tf.tile(
-        tf.expand_dims(tf.range(batch_size), 1), [1, num_samples])
-    index = tf.stack([batch_index, frame_index], 2)
-    return tf.gather_nd(model_input, index)
+    return tf.minimum(start_frame_index + frame_index_offset,
+                      tf.cast(num_frames - 1, tf.int32))
 
 
-def SampleRandomFrames(model_input, num_frames, num_samples):
-    """ Samples a random set of frames of size num_samples.
+def SampleRandomSequence(model_input, num_frames, num_samples,
+                         reader_sampling=None):
+    """ Samples a random sequence of frames of size num_samples.
 
-      Args:
+    Args:
         model_input: A tensor of size batch_size x max_frames x feature_size
         num_frames: A tensor of size batch_size x 1
         num_samples: A scalar
+        reader_sampling: The (sampling, num_samples) of the frames the reader
+          already sampled from every video, if any. The input is then returned
+          as it is when the reader sampled num_samples frames the same way.
 
-      Returns:
+    Returns:
         `model_input`: A tensor of size batch_size x num_samples x feature_size
       """
-    batch_size = tf.shape(model_input)[0]
-    frame_index = tf.cast(
+    if reader_sampling == ("random_sequence", num_samples):
+        return model_input
+    return GatherFrames(model_input,
+                         SampleRandomSequenceIndex(num_frames, num_samples))
+
+
+def SampleRandomFramesIndex(num_frames, num_samples):
+    """ Samples the indices of a random set of frames of size num_samples.
+
+      Args:
+        num_frames: A tensor of size batch_size x 1
+        num_samples: A scalar
+
+      Returns:
+        `frame_index`: An int32 tensor of size batch_size x num_samples
+      """
+    batch_size = tf.shape(num_frames)[0]
+    return tf.cast(
         tf.multiply(
             tf.random_uniform([batch_size, num_samples]),
             tf.tile(tf.cast(num_frames, tf.float32), [1, num_samples])), tf.int32)
-    batch_index = tf.tile(
-        tf.expand_dims(tf.range(batch_size), 1), [1, num_samples])
-    index = tf.stack([batch_index, frame_index], 2)
-    return tf.gather_nd(model_input, index)
+
+
+def SampleRandomFrames(model_input, num_frames, num_samples,
+                       reader_sampling=None):
+    """ Samples a random set of frames of size num_samples.
+
+      Args:
+        model_input: A tensor of size batch_size x max_frames x feature_size
+        num_frames: A tensor of size batch_size x 1
+        num_samples: A scalar
+        reader_sampling: The (sampling, num_samples) of the frames the reader
+          already sampled from every video, if any. The input is then returned
+          as it is when the reader sampled num_samples frames the same way.
+
+      Returns:
+        `model_input`: A tensor of size batch_size x num_samples x feature_size
+      """
+    if reader_sampling == ("random", num_samples):
+        return model_input
+    return GatherFrames(model_input,
+                         SampleRandomFramesIndex(num_frames, num_samples))
 
 
 def FramePooling(frames, method, **unused_params):
@@ -98,25 +140,42 @@ def FramePooling(frames, method, **unused_params):
     else:
         raise ValueError("Unrecognized pooling method: %s" % method)
         
-def SampleUniformFrames(model_input, num_frames, num_samples):
-    """ Uniformally samples (deterministically) a set of frames of size num_samples.
+def SampleUniformFramesIndex(num_frames, num_samples):
+    """ Uniformally samples (deterministically) the indices of a set of frames of size num_samples.
 
           Args:
-            model_input: A tensor of size batch_size x max_frames x feature_size
             num_frames: A tensor of size batch_size x 1
             num_samples: A scalar
 
           Returns:
-            `model_input`: A tensor of size batch_size x num_samples x feature_size
+            `frame_index`: An int32 tensor of size batch_size x num_samples
           """
-    batch_size      = tf.shape(model_input)[0]
+    batch_size      = tf.shape(num_frames)[0]
     even_dist_samp  = tf.expand_dims(tf.linspace(0.0, 1.0, num_samples+1), axis=0)
     even_dist_samp  = tf.slice(even_dist_samp, [0, 0], [1, num_samples])
-    frame_index = tf.cast(
+    return tf.cast(
         tf.multiply(
             tf.tile(even_dist_samp, [batch_size, 1]),
             tf.tile(tf.cast(num_frames, tf.float32), [1, num_samples])), tf.int32)
-    batch_index = tf.tile(
-        tf.expand_dims(tf.range(batch_size), 1), [1, num_samples])
-    index = tf.stack([batch_index, frame_index], 2)
-    return tf.gather_nd(model_input, index)
+
+
+def SampleUniformFrames(model_input, num_frames, num_samples,
+                        reader_sampling=None):
+    """ Uniformally samples (deterministically) a set of frames of size num_samples.
+
+          Args:
+            model_input: A tensor of size batch_size x max_frames x feature_size
+            num_frames: A tensor of size batch_size x 1
+            num_samples: A scalar
+            reader_sampling: The (sampling, num_samples) of the frames the
+              reader already sampled from every video, if any. The input is
+              then returned as it is when the reader sampled num_samples frames
+              the same way.
+
+          Returns:
+            `model_input`: A tensor of size batch_size x num_samples x feature_size
+          """
+    if reader_sampling == ("uniform", num_samples):
+        return model_input
+    return GatherFrames(model_input,
+                         SampleUniformFramesIndex(num_frames, num_samples))
@@ -0,0 +1,327 @@
+# Copyright 2018 Deep Topology All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Binary serving the predictions of an exported model over HTTP.
+
+The server loads a SavedModel written by export_model.ModelExporter, e.g.
+train_dir/export/step_N, and batches the concurrent requests together, up to
+--max_batch_size examples or until the oldest request waited
+--max_latency_ms.
+
+POST /predict takes a JSON object {"examples": [...]} of base64 encoded
+serialized Examples or SequenceExamples, and returns the JSON object
+{"video_id": [...], "class_indexes": [[...]], "predictions": [[...]]}.
+GET /stats returns the latency percentiles and the throughput counters.
+
+Example usage:
+```
+python prediction_server.py --export_dir=/tmp/yt8m_model/export/step_1000 \
+    --port=8500
+```
+"""
+# noinspection PyUnresolvedReferences
+import pathmagic
+import base64
+import collections
+import json
+import threading
+import time
+import numpy
+import tensorflow as tf
+from tensorflow import app
+from tensorflow import flags
+from tensorflow import logging
+from tensorflow.python.saved_model import signature_constants
+from tensorflow.python.saved_model import tag_constants
+
+try:
+    import queue                                            # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.request import urlopen
+except ImportError:
+    import Queue as queue                                   # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import urlopen
+
+FLAGS = flags.FLAGS
+
+if __name__ == "__main__":
+    flags.DEFINE_string("export_dir", "",
+                        "The SavedModel directory written by the model "
+                        "export, e.g. train_dir/export/step_N.")
+    flags.DEFINE_string("host", "localhost", "The host to listen on.")
+    flags.DEFINE_integer("port", 8500, "The port to listen on.")
+    flags.DEFINE_integer("max_batch_size", 256,
+                         "The maximum number of examples of a batch.")
+    flags.DEFINE_float("max_latency_ms", 10.0,
+                       "How long a request waits for other requests to be "
+                       "batched with, in milliseconds.")
+
+_OUTPUT_KEYS = ("video_id", "class_indexes", "predictions")
+
+
+class _Request(object):
+    """A pending prediction request."""
+
+    def __init__(self, examples):
+        self.examples = examples
+        self.arrival_time = time.time()
+        self.outputs = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class ServingStats(object):
+    """Latency and throughput counters of a PredictionServer."""
+
+    def __init__(self, window_size=10000):
+        """Construct a ServingStats.
+
+        Args:
+          window_size: how many of the latest request latencies to keep.
+        """
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=window_size)
+        self.start_time = time.time()
+        self.num_requests = 0
+        self.num_examples = 0
+        self.num_batches = 0
+
+    def add_batch(self, requests, finish_time):
+        with self._lock:
+            self.num_batches += 1
+            for request in requests:
+                self.num_requests += 1
+                self.num_examples += len(request.examples)
+                self._latencies.append(finish_time - request.arrival_time)
+
+    def get(self):
+        """Returns the counters and the latency percentiles in milliseconds."""
+        with self._lock:
+            latencies = numpy.array(self._latencies) * 1000.0
+            elapsed = time.time() - self.start_time
+            stats = {"num_requests": self.num_requests,
+                     "num_examples": self.num_examples,
+                     "num_batches": self.num_batches,
+                     "examples_per_second": self.num_examples / elapsed,
+                     "mean_batch_size": (float(self.num_examples) /
+                                         max(self.num_batches, 1))}
+        for percentile in (50, 90, 99):
+            stats["latency_ms_p%d" % percentile] = (
+                float(numpy.percentile(latencies, percentile))
+                if latencies.size else 0.0)
+        return stats
+
+
+class PredictionServer(object):
+    """Runs an exported model on dynamically batched requests."""
+
+    def __init__(self, export_dir, max_batch_size=256, max_latency_ms=10.0):
+        """Construct a PredictionServer and start its batching thread.
+
+        Args:
+          export_dir: the SavedModel directory written by the model export.
+          max_batch_size: the maximum number of examples of a batch. A larger
+            request is run as a batch of its own.
+          max_latency_ms: how long a request waits for other requests to be
+            batched with.
+        """
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.stats = ServingStats()
+
+        self._graph = tf.Graph()
+        self._session = tf.Session(graph=self._graph)
+        meta_graph_def = tf.saved_model.loader.load(
+            self._session, [tag_constants.SERVING], export_dir)
+        signature = meta_graph_def.signature_def[
+            signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY]
+        self._input = self._graph.get_tensor_by_name(
+            signature.inputs["example_bytes"].name)
+        self._outputs = [self._graph.get_tensor_by_name(
+            signature.outputs[key].name) for key in _OUTPUT_KEYS]
+        logging.info("Loaded the model of %s.", export_dir)
+
+        self._requests = queue.Queue()
+        self._next_request = None
+        self._thread = threading.Thread(target=self._run_batches)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def predict(self, examples):
+        """Predicts the top classes of serialized examples.
+
+        Args:
+          examples: a list of serialized Examples or SequenceExamples.
+
+        Returns:
+          A dict of the numpy video_id, class_indexes and predictions.
+        """
+        request = _Request(list(examples))
+        self._requests.put(request)
+        request.done.wait()
+        if request.error:
+            raise request.error
+        return request.outputs
+
+    def _next_batch(self):
+        """Waits for a request, then gathers more until the batch is full or
+        the first request waited max_latency."""
+        requests = [self._next_request or self._requests.get()]
+        self._next_request = None
+        batch_size = len(requests[0].examples)
+        deadline = requests[0].arrival_time + self.max_latency
+        while batch_size < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if batch_size + len(request.examples) > self.max_batch_size:
+                self._next_request = request
+                break
+            requests.append(request)
+            batch_size += len(request.examples)
+        return requests
+
+    def _run(self, requests):
+        """Runs the model on the examples of the requests, as one batch."""
+        examples = [example for request in requests
+                    for example in request.examples]
+        outputs = self._session.run(self._outputs, {self._input: examples})
+        start = 0
+        for request in requests:
+            stop = start + len(request.examples)
+            request.outputs = dict(
+                (key, output[start:stop])
+                for key, output in zip(_OUTPUT_KEYS, outputs))
+            start = stop
+
+    def _run_batches(self):
+        while True:
+            requests = self._next_batch()
+            try:
+                self._run(requests)
+            except Exception as e:
+                if len(requests) == 1:
+                    requests[0].error = e
+                else:
+                    # A malformed example fails the whole batch, so the requests
+                    # are run one by one for the error to only reach its own.
+                    for request in requests:
+                        try:
+                            self._run([request])
+                        except Exception as request_error:
+                            request.error = request_error
+            self.stats.add_batch(requests, time.time())
+            for request in requests:
+                request.done.set()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_http_server(prediction_server, host="localhost", port=8500):
+    """Creates an HTTP server for a PredictionServer.
+
+    Args:
+      prediction_server: the PredictionServer to run the requests on.
+      host: the host to listen on.
+      port: the port to listen on, or 0 to pick a free port.
+
+    Returns:
+      The HTTP server. Call serve_forever() to run it.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, code, result):
+            body = json.dumps(result).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._reply(200, prediction_server.stats.get())
+            else:
+                self._reply(404, {"error": "Unknown path %s." % self.path})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._reply(404, {"error": "Unknown path %s." % self.path})
+                return
+            try:
+                length = int(self.headers["Content-Length"])
+                request = json.loads(self.rfile.read(length).decode("utf-8"))
+                examples = [base64.b64decode(example)
+                            for example in request["examples"]]
+            except (ValueError, KeyError, TypeError) as e:
+                self._reply(400, {"error": str(e)})
+                return
+            try:
+                outputs = prediction_server.predict(examples)
+            except Exception as e:
+                self._reply(500, {"error": str(e)})
+                return
+            self._reply(200, {
+                "video_id": [video_id.decode("utf-8")
+                             for video_id in outputs["video_id"]],
+                "class_indexes": outputs["class_indexes"].tolist(),
+                "predictions": outputs["predictions"].tolist()})
+
+        def log_message(self, format, *args):
+            logging.debug(format, *args)
+
+    return _ThreadingHTTPServer((host, port), Handler)
+
+
+def request_predictions(url, examples):
+    """Sends serialized examples to a running server, e.g. for tests.
+
+    Args:
+      url: the URL of the server, e.g. 'http://localhost:8500'.
+      examples: a list of serialized Examples or SequenceExamples.
+
+    Returns:
+      The decoded JSON reply.
+    """
+    body = json.dumps({"examples": [base64.b64encode(example).decode("ascii")
+                                    for example in examples]})
+    return json.loads(urlopen(url + "/predict", body.encode("utf-8")).read()
+                      .decode("utf-8"))
+
+
+def main(unused_argv):
+    logging.set_verbosity(tf.logging.INFO)
+    if not FLAGS.export_dir:
+        raise ValueError("'export_dir' was not specified.")
+    prediction_server = PredictionServer(FLAGS.export_dir,
+                                         max_batch_size=FLAGS.max_batch_size,
+                                         max_latency_ms=FLAGS.max_latency_ms)
+    http_server = make_http_server(prediction_server, FLAGS.host, FLAGS.port)
+    logging.info("Serving on http://%s:%d.", FLAGS.host,
+                 http_server.server_address[1])
+    http_server.serve_forever()
+
+
+if __name__ == "__main__":
+    app.run()
@@ -0,0 +1,116 @@
+# Copyright 2018 Deep Topology All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Round trip of a model exported by ModelExporter through the HTTP server."""
+
+import os
+import threading
+
+import tensorflow as tf
+import tensorflow.contrib.slim as slim
+
+import export_model
+import models
+import prediction_server
+import readers
+
+try:
+    from urllib.error import HTTPError      # Python 3
+except ImportError:
+    from urllib2 import HTTPError           # Python 2
+
+_NUM_CLASSES = 30
+_FEATURE_SIZE = 4
+
+
+class _LinearModel(models.BaseModel):
+
+    def create_model(self, model_input, vocab_size, **unused_params):
+        return {"predictions": slim.fully_connected(
+            model_input, vocab_size, activation_fn=tf.nn.sigmoid)}
+
+
+def _make_example(video_id, value):
+    return tf.train.Example(features=tf.train.Features(feature={
+        "id": tf.train.Feature(bytes_list=tf.train.BytesList(
+            value=[video_id.encode("utf-8")])),
+        "labels": tf.train.Feature(int64_list=tf.train.Int64List(value=[1])),
+        "mean_rgb": tf.train.Feature(float_list=tf.train.FloatList(
+            value=[value] * _FEATURE_SIZE))})).SerializeToString()
+
+
+class PredictionServerTest(tf.test.TestCase):
+
+    def setUp(self):
+        super(PredictionServerTest, self).setUp()
+        reader = readers.YT8MAggregatedFeatureReader(
+            num_classes=_NUM_CLASSES, feature_sizes=[_FEATURE_SIZE],
+            feature_names=["mean_rgb"])
+        exporter = export_model.ModelExporter(frame_features=False,
+                                              model=_LinearModel(),
+                                              reader=reader)
+        checkpoint = os.path.join(self.get_temp_dir(), "model.ckpt")
+        with exporter.graph.as_default(), tf.Session() as session:
+            session.run(tf.global_variables_initializer())
+            checkpoint = exporter.saver.save(session, checkpoint, 1)
+        export_dir = os.path.join(self.get_temp_dir(), "export", "step_1")
+        exporter.export_model(export_dir, 1, checkpoint)
+
+        # A long latency budget, so that concurrent requests share a batch.
+        self.server = prediction_server.PredictionServer(
+            export_dir, max_batch_size=64, max_latency_ms=500)
+        self.http_server = prediction_server.make_http_server(self.server, port=0)
+        self.url = "http://localhost:%d" % self.http_server.server_address[1]
+        thread = threading.Thread(target=self.http_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+        super(PredictionServerTest, self).tearDown()
+
+    def test_round_trip(self):
+        result = prediction_server.request_predictions(
+            self.url, [_make_example("a", 0.1), _make_example("b", 0.2)])
+        self.assertEqual(["a", "b"], result["video_id"])
+        self.assertEqual(2, len(result["class_indexes"]))
+        self.assertEqual(20, len(result["predictions"][0]))
+        self.assertEqual(1, self.server.stats.get()["num_requests"])
+
+    def test_malformed_example_only_fails_its_request(self):
+        results = {}
+
+        def send(name, examples):
+            try:
+                results[name] = prediction_server.request_predictions(
+                    self.url, examples)
+            except HTTPError as e:
+                results[name] = e.code
+
+        threads = [
+            threading.Thread(target=send,
+                             args=("good", [_make_example("good", 0.5)])),
+            threading.Thread(target=send, args=("bad", [b"not an example"]))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(["good"], results["good"]["video_id"])
+        self.assertEqual(500, results["bad"])
+
+
+if __name__ == "__main__":
+    tf.test.main()
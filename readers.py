@@ -15,6 +15,7 @@
 """Provides readers configured for different datasets."""
 
 import tensorflow as tf
+import model_utils
 import utils
 
 from tensorflow import logging
@@ -137,14 +138,30 @@ class YT8MFrameFeatureReader(BaseReader):
     The TFRecords must contain SequenceExamples with the sparse in64 'labels'
     context feature and a fixed length byte-quantized feature vector, obtained
     from the features in 'feature_names'. The quantized features will be mapped
-    back into a range between min_quantized_value and max_quantized_value.
+    back into a range between min_quantized_value and max_quantized_value,
+    unless the reader is constructed with dequantize=False.
+
+    If num_samples is set, only num_samples frames of every video are
+    decoded, chosen by the 'uniform', 'random' or 'random_sequence' sampling
+    of model_utils. The models skip their own sampling of as many frames with
+    the same method when they are given frame_sampling as their
+    reader_sampling argument.
     """
 
+    _FRAME_SAMPLINGS = {
+        "uniform": model_utils.SampleUniformFramesIndex,
+        "random": model_utils.SampleRandomFramesIndex,
+        "random_sequence": model_utils.SampleRandomSequenceIndex,
+    }
+
     def __init__(self,
                num_classes=3862,
                feature_sizes=[1024, 128],
                feature_names=["rgb", "audio"],
-               max_frames=300):
+               max_frames=300,
+               dequantize=True,
+               num_samples=None,
+               sampling="uniform"):
         """Construct a YT8MFrameFeatureReader.
 
         Args:
@@ -152,6 +169,12 @@ class YT8MFrameFeatureReader(BaseReader):
           feature_sizes: positive integer(s) for the feature dimensions as a list.
           feature_names: the feature name(s) in the tensorflow record as a list.
           max_frames: the maximum number of frames to process.
+          dequantize: whether to dequantize the features. If False, the uint8
+            features are returned, padded with zeros, and the model input must
+            go through utils.NormalizeModelInput.
+          num_samples: if set, the number of frames to sample from every video.
+          sampling: how to sample the frames, 'uniform', 'random' or
+            'random_sequence'.
         """
 
         assert len(feature_names) == len(feature_sizes), \
@@ -162,45 +185,120 @@ class YT8MFrameFeatureReader(BaseReader):
         self.feature_sizes = feature_sizes
         self.feature_names = feature_names
         self.max_frames = max_frames
+        self.dequantize = dequantize
+        if sampling not in self._FRAME_SAMPLINGS:
+            raise ValueError("Unknown frame sampling '%s'." % sampling)
+        self.num_samples = num_samples
+        self.sampling = sampling
+
+    @property
+    def frame_sampling(self):
+        """The (sampling, num_samples) of the frames of every video, or None if
+        the reader decodes all of them."""
+        if not self.num_samples:
+            return None
+        return (self.sampling, self.num_samples)
+
+    def get_sampled_video_matrix(self,
+                                 features,
+                                 frame_index,
+                                 feature_size,
+                                 max_quantized_value,
+                                 min_quantized_value):
+        """Decodes the sampled frames of a batch of input strings.
+
+        Args:
+          features: raw feature values, a 'batch' x 'frames' string matrix
+            padded with empty strings.
+          frame_index: the 'batch' x num_samples indices of the frames to keep.
+          feature_size: length of each frame feature vector
+          max_quantized_value: the maximum of the quantized value.
+          min_quantized_value: the minimum of the quantized value.
+
+        Returns:
+          feature_matrix: 'batch' x num_samples x feature_size matrix of the
+            sampled frame-features. It is uint8 if the reader does not
+            dequantize.
+        """
+        # The empty frame gathered for a video without frames is decoded as
+        # zeros, like the padding of the frames which are not sampled.
+        features = tf.concat([features, tf.fill([tf.shape(features)[0], 1], "")], 1)
+        frames = model_utils.GatherFrames(features, frame_index)
+        is_frame = tf.not_equal(frames, "")
+        frames = tf.where(is_frame, frames,
+                          tf.fill(tf.shape(frames), "\0" * feature_size))
+        feature_matrix = tf.reshape(tf.decode_raw(frames, tf.uint8),
+                                    [-1, self.num_samples, feature_size])
+        if self.dequantize:
+            feature_matrix = utils.Dequantize(tf.cast(feature_matrix, tf.float32),
+                                              max_quantized_value,
+                                              min_quantized_value)
+        return feature_matrix * tf.cast(tf.expand_dims(is_frame, 2),
+                                        feature_matrix.dtype)
 
     def get_video_matrix(self,
-                       features,
-                       feature_size,
-                       max_frames,
-                       max_quantized_value,
-                       min_quantized_value):
-        """Decodes features from an input string and quantizes it.
+                         features,
+                         num_frames,
+                         feature_size,
+                         max_frames,
+                         max_quantized_value,
+                         min_quantized_value,
+                         pad_to_max_frames=True):
+        """Decodes features from a batch of input strings and quantizes them.
+
+        Only the frames which are kept are decoded, in a single decode_raw call
+        for the whole batch, and then scattered into the padded output.
 
         Args:
-          features: raw feature values
+          features: raw feature values, a 'batch' x 'frames' string matrix
+            padded with empty strings.
+          num_frames: number of frames of every video.
           feature_size: length of each frame feature vector
           max_frames: number of frames (rows) in the output feature_matrix
           max_quantized_value: the maximum of the quantized value.
           min_quantized_value: the minimum of the quantized value.
+          pad_to_max_frames: if False, the videos are only padded to the
+            longest video of the batch, capped at max_frames.
 
         Returns:
-          feature_matrix: matrix of all frame-features
-          num_frames: number of frames in the sequence
+          feature_matrix: 'batch' x max_frames x feature_size matrix of all
+            frame-features, padded with zeros. It is uint8 if the reader does
+            not dequantize.
+          num_frames: number of frames of every video, capped at max_frames.
         """
-        decoded_features = tf.reshape(
-            tf.cast(tf.decode_raw(features, tf.uint8), tf.float32),
+        num_frames = tf.minimum(tf.cast(num_frames, tf.int32), max_frames)
+        features = features[:, :max_frames]
+        mask = tf.sequence_mask(num_frames, tf.shape(features)[1])
+        frame_features = tf.reshape(
+            tf.decode_raw(tf.boolean_mask(features, mask), tf.uint8),
             [-1, feature_size])
-
-        num_frames = tf.minimum(tf.shape(decoded_features)[0], max_frames)
-        feature_matrix = utils.Dequantize(decoded_features,
-                                          max_quantized_value,
-                                          min_quantized_value)
-        feature_matrix = resize_axis(feature_matrix, 0, max_frames)
+        if self.dequantize:
+            frame_features = utils.Dequantize(tf.cast(frame_features, tf.float32),
+                                              max_quantized_value,
+                                              min_quantized_value)
+
+        batch_size = tf.shape(features)[0]
+        if pad_to_max_frames:
+            num_rows = max_frames
+        else:
+            num_rows = tf.shape(features)[1]
+            max_frames = None
+        feature_matrix = tf.scatter_nd(
+            tf.where(mask), frame_features,
+            tf.cast(tf.stack([batch_size, num_rows, feature_size]), tf.int64))
+        feature_matrix.set_shape([None, max_frames, feature_size])
         return feature_matrix, num_frames
 
     def prepare_reader(self,
-                     filename_queue,
-                     max_quantized_value=2,
-                     min_quantized_value=-2):
+                       filename_queue,
+                       batch_size=1024,
+                       max_quantized_value=2,
+                       min_quantized_value=-2):
         """Creates a single reader thread for YouTube8M SequenceExamples.
 
         Args:
           filename_queue: A tensorflow queue of filename locations.
+          batch_size: How many SequenceExamples to read and parse at a time.
           max_quantized_value: the maximum of the quantized value.
           min_quantized_value: the minimum of the quantized value.
 
@@ -208,16 +306,29 @@ class YT8MFrameFeatureReader(BaseReader):
           A tuple of video indexes, video features, labels, and padding data.
         """
         reader = tf.TFRecordReader()
-        _, serialized_example = reader.read(filename_queue)
+        _, serialized_examples = reader.read_up_to(filename_queue, batch_size)
 
-        return self.prepare_serialized_examples(serialized_example,
+        tf.add_to_collection("serialized_examples", serialized_examples)
+        return self.prepare_serialized_examples(serialized_examples,
             max_quantized_value, min_quantized_value)
 
-    def prepare_serialized_examples(self, serialized_example,
-                                    max_quantized_value=2, min_quantized_value=-2):
+    def prepare_serialized_examples(self, serialized_examples,
+                                    max_quantized_value=2, min_quantized_value=-2,
+                                    pad_to_max_frames=True):
+        """Parses a batch of serialized SequenceExamples.
 
-        contexts, features = tf.parse_single_sequence_example(
-            serialized_example,
+        Args:
+          serialized_examples: A 1-D string tensor of SequenceExamples.
+          max_quantized_value: the maximum of the quantized value.
+          min_quantized_value: the minimum of the quantized value.
+          pad_to_max_frames: if False, the videos are only padded to the
+            longest video of the batch.
+
+        Returns:
+          A tuple of video indexes, video features, labels, and padding data.
+        """
+        contexts, features, lengths = tf.io.parse_sequence_example(
+            serialized_examples,
             context_features={"id": tf.FixedLenFeature(
                 [], tf.string),
                 "labels": tf.VarLenFeature(tf.int64)},
@@ -227,10 +338,8 @@ class YT8MFrameFeatureReader(BaseReader):
             })
 
         # read ground truth labels
-        labels = (tf.cast(
-            tf.sparse_to_dense(contexts["labels"].values, (self.num_classes,), 1,
-                               validate_indices=False),
-            tf.bool))
+        labels = tf.sparse_to_indicator(contexts["labels"], self.num_classes)
+        labels.set_shape([None, self.num_classes])
 
         # loads (potentially) different types of features and concatenates them
         num_features = len(self.feature_names)
@@ -240,32 +349,47 @@ class YT8MFrameFeatureReader(BaseReader):
             "length of feature_names (={}) != length of feature_sizes (={})".format(len(self.feature_names),
                                                                                     len(self.feature_sizes))
 
-        num_frames = -1  # the number of frames in the video
+        # the number of frames of every video, given by its first feature
+        num_frames = lengths[self.feature_names[0]]
         feature_matrices = [None] * num_features  # an array of different features
+        if self.num_samples:
+            # All the features keep the same frames.
+            capped_num_frames = tf.minimum(tf.cast(num_frames, tf.int32),
+                                           self.max_frames)
+            # A video without frames samples the index 0, of an empty frame.
+            frame_index = self._FRAME_SAMPLINGS[self.sampling](
+                tf.cast(tf.expand_dims(tf.maximum(capped_num_frames, 1), 1),
+                        tf.float32),
+                self.num_samples)
+            for feature_index in range(num_features):
+                feature_matrices[feature_index] = self.get_sampled_video_matrix(
+                    features[self.feature_names[feature_index]],
+                    frame_index,
+                    self.feature_sizes[feature_index],
+                    max_quantized_value,
+                    min_quantized_value)
+            batch_video_matrix = tf.concat(feature_matrices, 2)
+            batch_frames = tf.fill(tf.shape(num_frames), self.num_samples)
+            return contexts["id"], batch_video_matrix, labels, batch_frames
+
         for feature_index in range(num_features):
             feature_matrix, num_frames_in_this_feature = self.get_video_matrix(
                 features[self.feature_names[feature_index]],
+                num_frames,
                 self.feature_sizes[feature_index],
                 self.max_frames,
                 max_quantized_value,
-                min_quantized_value)
-            if num_frames == -1:
-                num_frames = num_frames_in_this_feature
+                min_quantized_value,
+                pad_to_max_frames)
+            if feature_index == 0:
+                batch_frames = num_frames_in_this_feature
             else:
-                tf.assert_equal(num_frames, num_frames_in_this_feature)
+                tf.assert_equal(lengths[self.feature_names[0]],
+                                lengths[self.feature_names[feature_index]])
 
             feature_matrices[feature_index] = feature_matrix
 
-        # cap the number of frames at self.max_frames
-        num_frames = tf.minimum(num_frames, self.max_frames)
-
         # concatenate different features
-        video_matrix = tf.concat(feature_matrices, 1)
-
-        # convert to batch format.
-        batch_video_ids = tf.expand_dims(contexts["id"], 0)
-        batch_video_matrix = tf.expand_dims(video_matrix, 0)
-        batch_labels = tf.expand_dims(labels, 0)
-        batch_frames = tf.expand_dims(num_frames, 0)
+        batch_video_matrix = tf.concat(feature_matrices, 2)
 
-        return batch_video_ids, batch_video_matrix, batch_labels, batch_frames
+        return contexts["id"], batch_video_matrix, labels, batch_frames
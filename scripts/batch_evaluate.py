@@ -12,13 +12,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-""" A script to batch-evaluate the algorithm on different epochs. """
+""" A script to batch-evaluate the algorithm on different epochs.
+
+The validation set is read and decoded only once: the decoded batches are
+written to an on-disk cache (--decoded_cache_dir, or a temporary directory), and
+every checkpoint is then scored by feeding the memory-mapped batches to the
+evaluation graph.
+"""
+import os
+import sys
+
+# Explicitly add the repository's directory to the path list.
+file_dir = os.path.dirname(__file__)
+sys.path.append(os.path.join(file_dir, ".."))
+
 import glob
 import json
-import os
+import shutil
+import tempfile
 import time
-import sys
+import numpy
 import eval_util
+import input_utils
 import losses
 import video_level_models
 import frame_level_models
@@ -27,12 +42,36 @@ import tensorflow as tf
 from tensorflow.python.lib.io import file_io
 from tensorflow import app
 from tensorflow import flags
-from tensorflow import gfile
 from tensorflow import logging
 import utils
 
 FLAGS = flags.FLAGS
 
+if __name__ == "__main__":
+    flags.DEFINE_string("train_dir", "/tmp/yt8m_model/",
+                        "The directory to load the model checkpoints from. "
+                        "The tensorboard metrics files are also saved to this "
+                        "directory.")
+    flags.DEFINE_string(
+        "eval_data_pattern", "",
+        "File glob defining the evaluation dataset in tensorflow.SequenceExample "
+        "format. The SequenceExamples are expected to have an 'rgb' byte array "
+        "sequence feature as well as a 'labels' int64 context feature.")
+    flags.DEFINE_string("checkpoint_steps", "",
+                        "Comma separated list of the global steps of the "
+                        "checkpoints to evaluate. All the model.ckpt-* "
+                        "checkpoints in --train_dir are evaluated if empty.")
+    flags.DEFINE_string("decoded_cache_dir", "",
+                        "The local directory the decoded evaluation batches "
+                        "are cached in as .npy files, memory-mapped when "
+                        "scoring the checkpoints. If empty, a temporary "
+                        "directory is used and removed at the end.")
+
+    flags.DEFINE_integer("batch_size", 1024,
+                         "How many examples to process per batch.")
+    flags.DEFINE_integer("num_readers", 8,
+                         "How many threads to use for reading input files.")
+    flags.DEFINE_integer("top_k", 20, "How many predictions to output per video.")
 
 
 def find_class_by_name(name, modules):
@@ -63,21 +102,16 @@ def get_input_evaluation_tensors(reader,
     """
     logging.info("Using batch size of " + str(batch_size) + " for evaluation.")
     with tf.name_scope("eval_input"):
-        files = gfile.Glob(data_pattern)
+        files = input_utils.get_files(data_pattern)
         if not files:
             raise IOError("Unable to find the evaluation files.")
         logging.info("number of evaluation files: " + str(len(files)))
-        filename_queue = tf.train.string_input_producer(
-            files, shuffle=False, num_epochs=1)
-        eval_data = [
-            reader.prepare_reader(filename_queue) for _ in range(num_readers)
-        ]
-        return tf.train.batch_join(
-            eval_data,
+        return input_utils.get_input_tensors(
+            reader,
+            files,
             batch_size=batch_size,
-            capacity=3 * batch_size,
-            allow_smaller_final_batch=True,
-            enqueue_many=True)
+            num_epochs=1,
+            num_readers=num_readers)
 
 
 def build_graph(reader,
@@ -108,10 +142,8 @@ def build_graph(reader,
         num_readers=num_readers)
     tf.summary.histogram("model_input_raw", model_input_raw)
 
-    feature_dim = len(model_input_raw.get_shape()) - 1
-
     # Normalize input features.
-    model_input = tf.nn.l2_normalize(model_input_raw, feature_dim)
+    model_input = utils.NormalizeModelInput(model_input_raw, num_frames)
 
     with tf.variable_scope("tower"):
         result = model.create_model(model_input,
@@ -134,24 +166,93 @@ def build_graph(reader,
     tf.add_to_collection("video_id_batch", video_id_batch)
     tf.add_to_collection("num_frames", num_frames)
     tf.add_to_collection("labels", tf.cast(labels_batch, tf.float32))
+    tf.add_to_collection("labels_batch", labels_batch)
     tf.add_to_collection("summary_op", tf.summary.merge_all())
 
 
-def get_latest_checkpoint():
+def get_checkpoints():
+    """Returns the (global_step, checkpoint path) pairs to evaluate, by step."""
     index_files = file_io.get_matching_files(os.path.join(FLAGS.train_dir, 'model.ckpt-*.index'))
-    tf.logging.debug("Looking at {}".format(index_files))
+    checkpoints = sorted(
+        [(int(os.path.basename(f).split("-")[-1].split(".")[0]), f[:-6])
+         for f in index_files])
+    if FLAGS.checkpoint_steps:
+        steps = set(int(step) for step in FLAGS.checkpoint_steps.split(","))
+        checkpoints = [c for c in checkpoints if c[0] in steps]
+    return checkpoints
 
-    # No files
-    if not index_files:
-        return None
 
-    # Index file path with the maximum step size.
-    latest_index_file = sorted(
-        [(int(os.path.basename(f).split("-")[-1].split(".")[0]), f)
-         for f in index_files])[-1][1]
+def decode_evaluation_data(sess, input_tensors, cache_dir):
+    """Reads and decodes the whole evaluation set once.
 
-    # Chop off .index suffix and return
-    return latest_index_file[:-6]
+      Args:
+        sess: The session running the evaluation graph.
+        input_tensors: The list of input tensors to fetch for every batch.
+        cache_dir: Local directory for the decoded batches.
+
+      Returns:
+        A list with, for every batch, the list of the fetched values as
+        memory-mapped arrays.
+    """
+    sess.run([tf.local_variables_initializer()])
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    batches = []
+    examples_decoded = 0
+    start_time = time.time()
+    try:
+        while True:
+            values = sess.run(input_tensors)
+            # The decoded frames of a whole evaluation set do not fit in memory.
+            paths = [os.path.join(cache_dir, "batch_%06d_%d.npy" % (len(batches), i))
+                     for i in range(len(values))]
+            for path, value in zip(paths, values):
+                numpy.save(path, value)
+            values = [numpy.load(path, mmap_mode="r") for path in paths]
+            batches.append(values)
+            examples_decoded += values[0].shape[0]
+    except tf.errors.OutOfRangeError:
+        logging.info("Decoded %d evaluation examples in %.2f seconds.",
+                     examples_decoded, time.time() - start_time)
+    return batches
+
+
+def evaluate_checkpoint(sess, saver, checkpoint, global_step_val, batches,
+                        input_tensors, fetches, summary_writer, evl_metrics):
+    """Scores a checkpoint on the decoded evaluation batches.
+
+      Args:
+        sess: The session running the evaluation graph.
+        saver: a tensorflow saver to restore the model.
+        checkpoint: The path of the checkpoint to restore.
+        global_step_val: The global step of the checkpoint.
+        batches: The decoded batches returned by decode_evaluation_data.
+        input_tensors: The input tensors the batch values are fed to.
+        fetches: The prediction, label and loss tensors.
+        summary_writer: a tensorflow summary_writer
+        evl_metrics: an EvaluationMetrics object.
+    """
+    logging.info("Loading checkpoint for eval: " + checkpoint)
+    saver.restore(sess, checkpoint)
+    evl_metrics.clear()
+
+    start_time = time.time()
+    for values in batches:
+        predictions_val, labels_val, loss_val = sess.run(
+            fetches, feed_dict=dict(zip(input_tensors, values)))
+        evl_metrics.accumulate(predictions_val, labels_val, loss_val)
+    logging.info("Scored %d examples in %.2f seconds.", evl_metrics.num_examples,
+                 time.time() - start_time)
+
+    epoch_info_dict = evl_metrics.get()
+    epoch_info_dict["epoch_id"] = global_step_val
+    epochinfo = utils.AddEpochSummary(
+        summary_writer,
+        global_step_val,
+        epoch_info_dict,
+        summary_scope="Eval")
+    logging.info(epochinfo)
 
 
 def evaluate():
@@ -170,8 +271,10 @@ def evaluate():
             flags_dict["feature_names"], flags_dict["feature_sizes"])
 
         if flags_dict["frame_features"]:
+            # The frames are only dequantized by the model graph.
             reader = readers.YT8MFrameFeatureReader(feature_names=feature_names,
-                                                    feature_sizes=feature_sizes)
+                                                    feature_sizes=feature_sizes,
+                                                    dequantize=False)
         else:
             reader = readers.YT8MAggregatedFeatureReader(feature_names=feature_names,
                                                          feature_sizes=feature_sizes)
@@ -197,3 +300,39 @@ def evaluate():
             FLAGS.train_dir, graph=tf.get_default_graph())
 
         evl_metrics = eval_util.EvaluationMetrics(reader.num_classes, FLAGS.top_k)
+
+        input_tensors = [tf.get_collection("input_batch_raw")[0],
+                         tf.get_collection("labels_batch")[0],
+                         tf.get_collection("num_frames")[0]]
+        fetches = [tf.get_collection("predictions")[0],
+                   tf.get_collection("labels")[0],
+                   tf.get_collection("loss")[0]]
+        saver = tf.train.Saver(tf.global_variables())
+
+        checkpoints = get_checkpoints()
+        if not checkpoints:
+            raise IOError("No checkpoints to evaluate in %s." % FLAGS.train_dir)
+        logging.info("Evaluating %d checkpoints.", len(checkpoints))
+
+        cache_dir = FLAGS.decoded_cache_dir or tempfile.mkdtemp(
+            prefix="batch_evaluate_")
+        try:
+            with tf.Session() as sess:
+                batches = decode_evaluation_data(sess, input_tensors, cache_dir)
+                for global_step_val, checkpoint in checkpoints:
+                    evaluate_checkpoint(sess, saver, checkpoint, global_step_val,
+                                        batches, input_tensors, fetches,
+                                        summary_writer, evl_metrics)
+        finally:
+            if not FLAGS.decoded_cache_dir:
+                shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def main(unused_argv):
+    logging.set_verbosity(tf.logging.INFO)
+    print("tensorflow version: %s" % tf.__version__)
+    evaluate()
+
+
+if __name__ == "__main__":
+    app.run()
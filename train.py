@@ -26,6 +26,7 @@ import time
 
 import eval_util
 import export_model
+import input_utils
 import losses
 import frame_level_models
 import video_level_models
@@ -51,9 +52,18 @@ if __name__ == "__main__":
         "features (i.e. tensorflow.SequenceExample), then set --reader_type "
         "format. The (Sequence)Examples are expected to have 'rgb' byte array "
         "sequence feature as well as a 'labels' int64 context feature.")
+    flags.DEFINE_string(
+        "train_frame_cache_dir", "",
+        "If set, the frame-level training data is read from this frame cache "
+        "directory, written by frame_cache.py, instead of from "
+        "--train_data_pattern.")
     flags.DEFINE_string("feature_names", "mean_rgb", "Name of the feature "
                                                      "to use for training.")
     flags.DEFINE_string("feature_sizes", "1024", "Length of the feature vectors.")
+    flags.DEFINE_bool(
+        "quantized_input", False,
+        "If set, the frame-level features are kept as uint8 through the input "
+        "pipeline and only dequantized and normalized on the compute device.")
 
     # Model flags.
     flags.DEFINE_bool(
@@ -99,13 +109,55 @@ if __name__ == "__main__":
     flags.DEFINE_integer("export_model_steps", 1000,
                          "The period, in number of steps, with which the model "
                          "is exported for batch prediction.")
+    flags.DEFINE_integer("export_model_keep", 0,
+                         "How many of the latest model exports to keep. 0 "
+                         "keeps them all.")
+
+    flags.DEFINE_integer(
+        "reader_num_samples", 0,
+        "If positive, the reader only decodes this many frames of every video, "
+        "sampled with --reader_sampling. Models which sample as many frames "
+        "the same way use them as they are, instead of their own sampling. It "
+        "should match the number of frames the model samples, e.g. "
+        "--iterations. Not supported with --train_frame_cache_dir.")
+    flags.DEFINE_string(
+        "reader_sampling", "uniform",
+        "How the reader samples the frames: 'uniform', 'random' or "
+        "'random_sequence'.")
+    flags.DEFINE_string(
+        "bucket_boundaries", "",
+        "Comma separated increasing numbers of frames. If set, the frame-level "
+        "videos are batched by bucket of num_frames and only padded to the "
+        "longest video of their batch. The model must then support a dynamic "
+        "frame dimension, e.g. by sampling a fixed number of frames.")
 
     # Other flags.
     flags.DEFINE_integer("num_readers", 8,
                          "How many threads to use for reading input files.")
+    flags.DEFINE_string(
+        "prefetch_cache_dir", "",
+        "If set, the training files are copied into this local directory by "
+        "background threads before they are read, and deleted after use. "
+        "Use a directory under /dev/shm to cache them in memory.")
+    flags.DEFINE_integer("num_prefetch_files", 8,
+                         "How many training files to copy ahead of the "
+                         "readers, in parallel, with --prefetch_cache_dir.")
     flags.DEFINE_string("optimizer", "AdamOptimizer",
                         "What optimizer class to use.")
     flags.DEFINE_float("clip_gradient_norm", 1.0, "Norm to clip gradients to.")
+    flags.DEFINE_bool(
+        "clip_global_norm", False,
+        "If set, the gradients are clipped together by their global norm "
+        "instead of every gradient by its own norm.")
+    flags.DEFINE_string(
+        "gradient_reduction", "add_n",
+        "How the gradients of the GPU towers are summed: 'add_n', "
+        "'hierarchical' (pairwise sums across the GPUs) or 'nccl'.")
+    flags.DEFINE_bool(
+        "graph_metrics", False,
+        "If set, the training metrics are computed from the top predictions "
+        "of the batch, selected in the graph, instead of from the full "
+        "predictions and labels.")
     flags.DEFINE_bool(
         "log_device_placement", False,
         "Whether to write the device on which every op will run into the "
@@ -142,7 +194,13 @@ def get_input_data_tensors(reader,
                            data_pattern,
                            batch_size=1000,
                            num_epochs=None,
-                           num_readers=1):
+                           num_readers=1,
+                           frame_cache_dir=None,
+                           bucket_boundaries=None,
+                           num_shards=1,
+                           shard_index=0,
+                           prefetch_cache_dir=None,
+                           num_prefetch_files=8):
     """Creates the section of the graph which reads the training data.
       Args:
         reader: A class which parses the training data.
@@ -151,6 +209,16 @@ def get_input_data_tensors(reader,
         num_epochs: How many passes to make over the training data. Set to 'None'
                     to run indefinitely.
         num_readers: How many I/O threads to use.
+        frame_cache_dir: If set, the frame cache to read instead of the data
+                         files.
+        bucket_boundaries: If set, the num_frames bucket boundaries to batch
+                           the videos by.
+        num_shards: How many shards the training data is split into, one per
+                    training task.
+        shard_index: Which shard to read. It also seeds the shuffling.
+        prefetch_cache_dir: If set, the local directory to copy the files to
+                            before they are read.
+        num_prefetch_files: How many files to copy ahead of the readers.
       Returns:
         A tuple containing the features tensor, labels tensor, and optionally a
         tensor containing the number of frames per video. The exact dimensions
@@ -160,28 +228,41 @@ def get_input_data_tensors(reader,
       """
     logging.info("Using batch size of " + str(batch_size) + " for training.")
     with tf.name_scope("train_input"):
-        file_dirs = data_pattern.split(",")
-        files = list()
-        for f in file_dirs:
-            cur_file = gfile.Glob(f)
-            files.extend(cur_file)
+        if frame_cache_dir:
+            return input_utils.get_frame_cache_input_tensors(
+                reader,
+                frame_cache_dir,
+                batch_size=batch_size,
+                num_epochs=num_epochs,
+                shuffle=True,
+                num_shards=num_shards,
+                shard_index=shard_index,
+                seed=shard_index)
+        files = input_utils.get_files(data_pattern, num_shards, shard_index)
         if not files:
-            raise IOError("Unable to find training files. data_pattern='" +
-                          data_pattern + "'.")
-        logging.info("Number of training files: %s.", str(len(files)))
-        filename_queue = tf.train.string_input_producer(
-            files, num_epochs=num_epochs, shuffle=True)
-        training_data = [
-            reader.prepare_reader(filename_queue) for _ in range(num_readers)
-        ]
-
-        return tf.train.shuffle_batch_join(
-            training_data,
+            raise IOError("Unable to find training files for shard %d of %d. "
+                          "data_pattern='%s'." % (shard_index, num_shards,
+                                                  data_pattern))
+        logging.info("Number of training files of shard %d of %d: %d, read "
+                     "%s times.", shard_index, num_shards, len(files),
+                     num_epochs)
+        prefetcher = None
+        if prefetch_cache_dir:
+            prefetcher = input_utils.FilePrefetcher(
+                prefetch_cache_dir,
+                num_prefetch=num_prefetch_files,
+                num_keep=input_utils.num_open_files(num_readers),
+                num_threads=num_prefetch_files)
+        return input_utils.get_input_tensors(
+            reader,
+            files,
             batch_size=batch_size,
-            capacity=batch_size * 5,
-            min_after_dequeue=batch_size,
-            allow_smaller_final_batch=True,
-            enqueue_many=True)
+            num_epochs=num_epochs,
+            shuffle=True,
+            num_readers=num_readers,
+            seed=shard_index,
+            bucket_boundaries=bucket_boundaries,
+            prefetcher=prefetcher)
 
 
 def find_class_by_name(name, modules):
@@ -200,9 +281,17 @@ def build_graph(reader,
                 learning_rate_decay=0.95,
                 optimizer_class=tf.train.AdamOptimizer,
                 clip_gradient_norm=1.0,
+                clip_global_norm=False,
+                gradient_reduction="add_n",
                 regularization_penalty=1,
                 num_readers=1,
-                num_epochs=None):
+                num_epochs=None,
+                frame_cache_dir=None,
+                bucket_boundaries=None,
+                num_shards=1,
+                shard_index=0,
+                prefetch_cache_dir=None,
+                num_prefetch_files=8):
     """Creates the Tensorflow graph.
       This will only be called once in the life of
       a training model, because after the graph is created the model will be
@@ -218,11 +307,25 @@ def build_graph(reader,
         base_learning_rate: What learning rate to initialize the optimizer with.
         optimizer_class: Which optimization algorithm to use.
         clip_gradient_norm: Magnitude of the gradient to clip to.
+        clip_global_norm: Whether clip_gradient_norm bounds the global norm of
+                          all the gradients rather than the norm of each one.
+        gradient_reduction: How the gradients of the towers are summed, see
+                            utils.combine_gradients.
         regularization_penalty: How much weight to give the regularization loss
                                 compared to the label loss.
         num_readers: How many threads to use for I/O operations.
         num_epochs: How many passes to make over the data. 'None' means an
                     unlimited number of passes.
+        frame_cache_dir: If set, the frame cache to read the training data from.
+        bucket_boundaries: If set, the num_frames bucket boundaries to batch
+                           the videos by.
+        num_shards: How many shards the training data is split into.
+        shard_index: Which shard of the training data this task reads.
+        prefetch_cache_dir: If set, the local directory to copy the training
+                            files to before they are read.
+        num_prefetch_files: How many files to copy ahead of the readers.
+      Raises:
+        ValueError: if gradient_reduction is nccl without at least 2 GPUs.
       """
 
     global_step = tf.Variable(0, trainable=False, name="global_step")
@@ -241,6 +344,10 @@ def build_graph(reader,
         num_towers = 1
         device_string = '/cpu:%d'
 
+    if gradient_reduction == "nccl" and num_gpus < 2:
+        raise ValueError("--gradient_reduction=nccl requires at least 2 GPUs, "
+                         "found %d. Use add_n or hierarchical instead." % num_gpus)
+
     learning_rate = tf.train.exponential_decay(
         base_learning_rate,
         global_step * batch_size * num_towers,
@@ -256,14 +363,19 @@ def build_graph(reader,
             train_data_pattern,
             batch_size=batch_size * num_towers,
             num_readers=num_readers,
-            num_epochs=num_epochs))
+            num_epochs=num_epochs,
+            frame_cache_dir=frame_cache_dir,
+            bucket_boundaries=bucket_boundaries,
+            num_shards=num_shards,
+            shard_index=shard_index,
+            prefetch_cache_dir=prefetch_cache_dir,
+            num_prefetch_files=num_prefetch_files))
     tf.summary.histogram("model/input_raw", model_input_raw)
 
-    feature_dim = len(model_input_raw.get_shape()) - 1
-
-    model_input = tf.nn.l2_normalize(model_input_raw, feature_dim)
-
-    tower_inputs = tf.split(model_input, num_towers)
+    # The frame cache keeps all the frames, whatever the reader samples.
+    reader_sampling = (None if frame_cache_dir else
+                       getattr(reader, "frame_sampling", None))
+    tower_inputs = tf.split(model_input_raw, num_towers)
     tower_labels = tf.split(labels_batch, num_towers)
     tower_num_frames = tf.split(num_frames, num_towers)
     tower_gradients = []
@@ -274,6 +386,9 @@ def build_graph(reader,
         # For some reason these 'with' statements can't be combined onto the same
         # line. They have to be nested.
         with tf.device(device_string % i):
+            # Quantized input is only dequantized on the tower's device.
+            tower_inputs[i] = utils.NormalizeModelInput(tower_inputs[i],
+                                                        tower_num_frames[i])
             with (tf.variable_scope(("tower"), reuse=True if i > 0 else None)):
                 with (
                 slim.arg_scope([slim.model_variable, slim.variable], device="/cpu:0" if num_gpus != 1 else "/gpu:0")):
@@ -281,7 +396,8 @@ def build_graph(reader,
                         tower_inputs[i],
                         num_frames=tower_num_frames[i],
                         vocab_size=reader.num_classes,
-                        labels=tower_labels[i])
+                        labels=tower_labels[i],
+                        reader_sampling=reader_sampling)
                     for variable in slim.get_model_variables():
                         tf.summary.histogram(variable.op.name, variable)
 
@@ -327,11 +443,17 @@ def build_graph(reader,
     if regularization_penalty != 0:
         reg_loss = tf.reduce_mean(tf.stack(tower_reg_losses))
         tf.summary.scalar("reg_loss", reg_loss)
-    merged_gradients = utils.combine_gradients(tower_gradients)
+    merged_gradients = utils.combine_gradients(tower_gradients,
+                                               gradient_reduction)
 
     if clip_gradient_norm > 0:
         with tf.name_scope('clip_grads'):
-            merged_gradients = utils.clip_gradient_norms(merged_gradients, clip_gradient_norm)
+            if clip_global_norm:
+                merged_gradients, global_norm = utils.clip_gradient_global_norm(
+                    merged_gradients, clip_gradient_norm)
+                tf.summary.scalar("global_gradient_norm", global_norm)
+            else:
+                merged_gradients = utils.clip_gradient_norms(merged_gradients, clip_gradient_norm)
 
     train_op = optimizer.apply_gradients(merged_gradients, global_step=global_step)
 
@@ -339,7 +461,7 @@ def build_graph(reader,
     tf.add_to_collection("loss", label_loss)
     tf.add_to_collection("predictions", tf.concat(tower_predictions, 0))
     tf.add_to_collection("input_batch_raw", model_input_raw)
-    tf.add_to_collection("input_batch", model_input)
+    tf.add_to_collection("input_batch", tf.concat(tower_inputs, 0))
     tf.add_to_collection("num_frames", num_frames)
     tf.add_to_collection("labels", tf.cast(labels_batch, tf.float32))
     tf.add_to_collection("train_op", train_op)
@@ -350,7 +472,8 @@ class Trainer(object):
 
     def __init__(self, cluster, task, train_dir, model, reader, model_exporter,
                  log_device_placement=True, max_steps=None,
-                 export_model_steps=1000):
+                 export_model_steps=1000, export_model_keep=0,
+                 graph_metrics=False):
         """"Creates a Trainer.
         Args:
           cluster: A tf.train.ClusterSpec if the execution is distributed.
@@ -370,7 +493,11 @@ class Trainer(object):
         self.max_steps = max_steps
         self.max_steps_reached = False
         self.export_model_steps = export_model_steps
+        self.export_model_keep = export_model_keep
+        self.graph_metrics = graph_metrics
         self.last_model_export_step = 0
+        self.num_input_shards, self.input_shard_index = get_input_shard(
+            cluster, task)
 
     #     if self.is_master and self.task.index > 0:
     #       raise StandardError("%s: Only one replica of master expected",
@@ -412,7 +539,17 @@ class Trainer(object):
 
         target, device_fn = self.start_server_if_distributed()
 
-        meta_filename = self.get_meta_filename(start_new_model, self.train_dir)
+        # The input pipeline of a meta graph reads the shard of the task which
+        # wrote it, so distributed tasks rebuild their graph to read their own.
+        # The frame cache and the prefetched files are read by a python
+        # generator, which a meta graph cannot restore, so their graph is
+        # rebuilt too. The Supervisor restores the variables of a rebuilt graph
+        # from the latest checkpoint.
+        if (self.cluster or FLAGS.train_frame_cache_dir or
+                FLAGS.prefetch_cache_dir):
+            meta_filename = None
+        else:
+            meta_filename = self.get_meta_filename(start_new_model, self.train_dir)
 
         with tf.Graph().as_default() as graph:
             if meta_filename:
@@ -427,6 +564,12 @@ class Trainer(object):
                 predictions = tf.get_collection("predictions")[0]
                 labels = tf.get_collection("labels")[0]
                 train_op = tf.get_collection("train_op")[0]
+                if self.graph_metrics:
+                    # Only the top predictions of the batch are fetched.
+                    metrics = utils.build_top_k_metrics(predictions, labels)
+                    fetches = [train_op, global_step, loss, metrics]
+                else:
+                    fetches = [train_op, global_step, loss, predictions, labels]
                 init_op = tf.global_variables_initializer()
 
         sv = tf.train.Supervisor(
@@ -439,80 +582,115 @@ class Trainer(object):
             save_summaries_secs=120,
             saver=saver)
 
+        # The models are exported in the background, off the training loop.
+        self.async_exporter = None
+        if self.is_master:
+            self.async_exporter = export_model.AsyncModelExporter(
+                self.model_exporter, os.path.join(self.train_dir, "export"),
+                keep=self.export_model_keep)
+
         logging.info("%s: Starting managed session.", task_as_string(self.task))
-        with sv.managed_session(target, config=self.config) as sess:
-            try:
-                logging.info("%s: Entering training loop.", task_as_string(self.task))
-                while (not sv.should_stop()) and (not self.max_steps_reached):
-                    batch_start_time = time.time()
-                    _, global_step_val, loss_val, predictions_val, labels_val = sess.run(
-                        [train_op, global_step, loss, predictions, labels])
-                    seconds_per_batch = time.time() - batch_start_time
-                    examples_per_second = labels_val.shape[0] / seconds_per_batch
-
-                    if self.max_steps and self.max_steps <= global_step_val:
-                        self.max_steps_reached = True
-
-                    if self.is_master and global_step_val % 10 == 0 and self.train_dir:
-                        eval_start_time = time.time()
-                        hit_at_one = eval_util.calculate_hit_at_one(predictions_val, labels_val)
-                        perr = eval_util.calculate_precision_at_equal_recall_rate(predictions_val,
-                                                                                  labels_val)
-                        gap = eval_util.calculate_gap(predictions_val, labels_val)
-                        eval_end_time = time.time()
-                        eval_time = eval_end_time - eval_start_time
-
-                        logging.info("training step " + str(global_step_val) + " | Loss: " + ("%.2f" % loss_val) +
-                                     " Examples/sec: " + ("%.2f" % examples_per_second) + " | Hit@1: " +
-                                     ("%.2f" % hit_at_one) + " PERR: " + ("%.2f" % perr) +
-                                     " GAP: " + ("%.2f" % gap))
-
-                        sv.summary_writer.add_summary(
-                            utils.MakeSummary("model/Training_Hit@1", hit_at_one),
-                            global_step_val)
-                        sv.summary_writer.add_summary(
-                            utils.MakeSummary("model/Training_Perr", perr), global_step_val)
-                        sv.summary_writer.add_summary(
-                            utils.MakeSummary("model/Training_GAP", gap), global_step_val)
-                        sv.summary_writer.add_summary(
-                            utils.MakeSummary("global_step/Examples/Second",
-                                              examples_per_second), global_step_val)
-                        sv.summary_writer.flush()
-
-                        # Exporting the model every x steps
-                        time_to_export = ((self.last_model_export_step == 0) or
-                                          (global_step_val - self.last_model_export_step
-                                           >= self.export_model_steps))
-
-                        if self.is_master and time_to_export:
-                            self.export_model(global_step_val, sv.saver, sv.save_path, sess)
-                            self.last_model_export_step = global_step_val
-                    else:
-                        logging.info("training step " + str(global_step_val) + " | Loss: " +
-                                     ("%.2f" % loss_val) + " Examples/sec: " + ("%.2f" % examples_per_second))
-            except tf.errors.OutOfRangeError:
-                logging.info("%s: Done training -- epoch limit reached.",
-                             task_as_string(self.task))
+        try:
+            with sv.managed_session(target, config=self.config) as sess:
+                try:
+                    logging.info("%s: Entering training loop.", task_as_string(self.task))
+                    while (not sv.should_stop()) and (not self.max_steps_reached):
+                        batch_start_time = time.time()
+                        if self.graph_metrics:
+                            _, global_step_val, loss_val, metrics_val = sess.run(fetches)
+                            batch_size = metrics_val["top_indices"].shape[0]
+                        else:
+                            _, global_step_val, loss_val, predictions_val, labels_val = sess.run(
+                                fetches)
+                            batch_size = labels_val.shape[0]
+                        seconds_per_batch = time.time() - batch_start_time
+                        examples_per_second = batch_size / seconds_per_batch
+
+                        if self.max_steps and self.max_steps <= global_step_val:
+                            self.max_steps_reached = True
+
+                        if self.is_master and global_step_val % 10 == 0 and self.train_dir:
+                            eval_start_time = time.time()
+                            if self.graph_metrics:
+                                hit_at_one = metrics_val["hit_at_one"]
+                                perr = metrics_val["perr"]
+                                gap = eval_util.calculate_gap_top_k(metrics_val["top_predictions"],
+                                                                    metrics_val["top_labels"],
+                                                                    metrics_val["num_positives"])
+                            else:
+                                hit_at_one = eval_util.calculate_hit_at_one(predictions_val, labels_val)
+                                perr = eval_util.calculate_precision_at_equal_recall_rate(predictions_val,
+                                                                                          labels_val)
+                                gap = eval_util.calculate_gap(predictions_val, labels_val)
+                            eval_end_time = time.time()
+                            eval_time = eval_end_time - eval_start_time
+
+                            logging.info("training step " + str(global_step_val) + " | Loss: " + ("%.2f" % loss_val) +
+                                         " Examples/sec: " + ("%.2f" % examples_per_second) + " | Hit@1: " +
+                                         ("%.2f" % hit_at_one) + " PERR: " + ("%.2f" % perr) +
+                                         " GAP: " + ("%.2f" % gap))
+
+                            sv.summary_writer.add_summary(
+                                utils.MakeSummary("model/Training_Hit@1", hit_at_one),
+                                global_step_val)
+                            sv.summary_writer.add_summary(
+                                utils.MakeSummary("model/Training_Perr", perr), global_step_val)
+                            sv.summary_writer.add_summary(
+                                utils.MakeSummary("model/Training_GAP", gap), global_step_val)
+                            sv.summary_writer.add_summary(
+                                utils.MakeSummary("global_step/Examples/Second",
+                                                  examples_per_second), global_step_val)
+                            sv.summary_writer.flush()
+
+                            # Exporting the model every x steps
+                            time_to_export = ((self.last_model_export_step == 0) or
+                                              (global_step_val - self.last_model_export_step
+                                               >= self.export_model_steps))
+
+                            if self.is_master and time_to_export:
+                                self.export_model(global_step_val, sv.saver, sv.save_path, sess)
+                        else:
+                            logging.info("training step " + str(global_step_val) + " | Loss: " +
+                                         ("%.2f" % loss_val) + " Examples/sec: " + ("%.2f" % examples_per_second))
+                except tf.errors.OutOfRangeError:
+                    logging.info("%s: Done training -- epoch limit reached.",
+                                 task_as_string(self.task))
+
+                # The last checkpoint is always exported, after the pending export.
+                if self.is_master:
+                    self.export_model(sess.run(global_step), sv.saver, sv.save_path, sess,
+                                      block=True)
+        finally:
+            if self.async_exporter:
+                self.async_exporter.close()
 
         logging.info("%s: Exited training loop.", task_as_string(self.task))
         sv.Stop()
 
 
-    def export_model(self, global_step_val, saver, save_path, session):
+    def export_model(self, global_step_val, saver, save_path, session, block=False):
+        """Saves a checkpoint and submits it to the background exporter.
+
+        Unless block is set, the export is skipped while the previous one is
+        still running, and is retried at the next logged step.
+
+        Returns:
+          Whether the model was submitted for export at this step.
+        """
         # If the model has already been exported at this step, return.
         if global_step_val == self.last_model_export_step:
-            return
+            return True
+        if not block and self.async_exporter.full():
+            return False
 
         last_checkpoint = saver.save(session, save_path, global_step_val)
 
-        model_dir = "{0}/export/step_{1}".format(self.train_dir, global_step_val)
-        logging.info("%s: Exporting the model at step %s to %s.",
-                     task_as_string(self.task), global_step_val, model_dir)
-
-        self.model_exporter.export_model(
-            model_dir=model_dir,
-            global_step_val=global_step_val,
-            last_checkpoint=last_checkpoint)
+        logging.info("%s: Exporting the model at step %s in the background.",
+                     task_as_string(self.task), global_step_val)
+        if not self.async_exporter.submit(global_step_val, last_checkpoint, block=block):
+            return False
+        self.last_model_export_step = global_step_val
+        return True
 
 
     def start_server_if_distributed(self):
@@ -580,6 +758,8 @@ class Trainer(object):
                     model=model,
                     optimizer_class=optimizer_class,
                     clip_gradient_norm=FLAGS.clip_gradient_norm,
+                    clip_global_norm=FLAGS.clip_global_norm,
+                    gradient_reduction=FLAGS.gradient_reduction,
                     train_data_pattern=FLAGS.train_data_pattern,
                     label_loss_fn=label_loss_fn,
                     base_learning_rate=FLAGS.base_learning_rate,
@@ -588,7 +768,15 @@ class Trainer(object):
                     regularization_penalty=FLAGS.regularization_penalty,
                     num_readers=FLAGS.num_readers,
                     batch_size=FLAGS.batch_size,
-                    num_epochs=FLAGS.num_epochs)
+                    num_epochs=FLAGS.num_epochs,
+                    frame_cache_dir=FLAGS.train_frame_cache_dir,
+                    bucket_boundaries=[int(boundary) for boundary in
+                                       FLAGS.bucket_boundaries.split(",")
+                                       if boundary.strip()],
+                    num_shards=self.num_input_shards,
+                    shard_index=self.input_shard_index,
+                    prefetch_cache_dir=FLAGS.prefetch_cache_dir,
+                    num_prefetch_files=FLAGS.num_prefetch_files)
 
         return tf.train.Saver(max_to_keep=0, keep_checkpoint_every_n_hours=1.0)
 
@@ -600,7 +788,10 @@ def get_reader():
 
     if FLAGS.frame_features:
         reader = readers.YT8MFrameFeatureReader(
-            feature_names=feature_names, feature_sizes=feature_sizes)
+            feature_names=feature_names, feature_sizes=feature_sizes,
+            dequantize=not FLAGS.quantized_input,
+            num_samples=FLAGS.reader_num_samples or None,
+            sampling=FLAGS.reader_sampling)
     else:
         reader = readers.YT8MAggregatedFeatureReader(
             feature_names=feature_names, feature_sizes=feature_sizes)
@@ -631,6 +822,31 @@ class ParameterServer(object):
         server.join()
 
 
+def get_input_shard(cluster, task):
+    """Assigns a shard of the training data to a training task.
+
+      The master and worker tasks each read a distinct shard, so that every
+      file is read by exactly one task per epoch.
+
+      Args:
+        cluster: A tf.train.ClusterSpec if the execution is distributed.
+          None otherwise.
+        task: A TaskSpec describing the job type and the task index.
+
+      Returns:
+        A tuple of the number of shards and the shard index of the task.
+      """
+    if not cluster:
+        return 1, 0
+    num_masters = cluster.num_tasks("master") if "master" in cluster.jobs else 0
+    num_workers = cluster.num_tasks("worker") if "worker" in cluster.jobs else 0
+    if task.type == "master":
+        shard_index = task.index
+    else:
+        shard_index = num_masters + task.index
+    return num_masters + num_workers, shard_index
+
+
 def start_server(cluster, task):
     """Creates a Server.
       Args:
@@ -681,6 +897,17 @@ def main(unused_argv):
                                    [frame_level_models, video_level_models])()
 
         reader = get_reader()
+        if FLAGS.train_frame_cache_dir and not FLAGS.frame_features:
+            raise ValueError("--train_frame_cache_dir requires "
+                             "--frame_features.")
+        if FLAGS.train_frame_cache_dir and FLAGS.reader_num_samples:
+            raise ValueError("--reader_num_samples is not supported with "
+                             "--train_frame_cache_dir, whose videos keep all "
+                             "their frames.")
+        if FLAGS.bucket_boundaries and (FLAGS.train_frame_cache_dir or
+                                        not FLAGS.frame_features):
+            raise ValueError("--bucket_boundaries requires --frame_features "
+                             "and TFRecord training data.")
 
         model_exporter = export_model.ModelExporter(
             frame_features=FLAGS.frame_features,
@@ -689,7 +916,9 @@ def main(unused_argv):
 
         Trainer(cluster, task, FLAGS.train_dir, model, reader, model_exporter,
                 FLAGS.log_device_placement, FLAGS.max_steps,
-                FLAGS.export_model_steps).run(start_new_model=FLAGS.start_new_model)
+                FLAGS.export_model_steps,
+                FLAGS.export_model_keep,
+                FLAGS.graph_metrics).run(start_new_model=FLAGS.start_new_model)
 
     elif task.type == "ps":
         ParameterServer(cluster, task).run()
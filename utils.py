@@ -43,6 +43,27 @@ def Dequantize(feat_vector, max_quantized_value=2, min_quantized_value=-2):
     return feat_vector * scalar + bias
 
 
+def NormalizeModelInput(model_input_raw, num_frames):
+    """L2 normalizes the input features, dequantizing them if needed.
+
+      Args:
+        model_input_raw: the float input features, or the 'batch' x 'frames' x
+          'feature_size' uint8 frames of a reader which keeps them quantized.
+        num_frames: the number of frames of every video. The padding frames of
+          uint8 input are set to zero.
+
+      Returns:
+        The normalized float features.
+    """
+    feature_dim = len(model_input_raw.get_shape()) - 1
+    if model_input_raw.dtype == tf.uint8:
+        mask = tf.sequence_mask(num_frames, tf.shape(model_input_raw)[1],
+                                dtype=tf.float32)
+        model_input_raw = Dequantize(
+            tf.cast(model_input_raw, tf.float32)) * tf.expand_dims(mask, 2)
+    return tf.nn.l2_normalize(model_input_raw, feature_dim)
+
+
 def MakeSummary(name, value):
     """Creates a tf.Summary proto with the given name and value."""
     summary = tf.Summary()
@@ -189,7 +210,58 @@ def clip_gradient_norms(gradients_to_variables, max_norm):
     return clipped_grads_and_vars
 
 
-def combine_gradients(tower_grads):
+def clip_gradient_global_norm(gradients_to_variables, max_norm):
+    """Clips the gradients by the ratio of their global norm to max_norm.
+
+      Unlike clip_gradient_norms, a single norm is computed over all the
+      gradients, so their relative scale is kept.
+
+      Args:
+        gradients_to_variables: A list of gradient to variable pairs (tuples).
+        max_norm: the maximum global norm value.
+
+      Returns:
+        A tuple of the list of clipped gradient to variable pairs and the
+        global norm of the gradients before clipping.
+    """
+    grads, variables = zip(*gradients_to_variables)
+    clipped_grads, global_norm = tf.clip_by_global_norm(grads, max_norm)
+    return list(zip(clipped_grads, variables)), global_norm
+
+
+def _sum_indexed_slices(grads):
+    """Sums IndexedSlices by concatenating them, without making them dense."""
+    return tf.IndexedSlices(tf.concat([grad.values for grad in grads], 0),
+                            tf.concat([grad.indices for grad in grads], 0),
+                            grads[0].dense_shape)
+
+
+def _sum_hierarchical(grads):
+    """Sums the tensors pairwise, each pair on the device of its first tensor,
+    so that every device only receives a tensor per level of the tree."""
+    while len(grads) > 1:
+        pairs = []
+        for i in xrange(0, len(grads) - 1, 2):
+            with tf.device(grads[i].device):
+                pairs.append(grads[i] + grads[i + 1])
+        if len(grads) % 2:
+            pairs.append(grads[-1])
+        grads = pairs
+    return grads[0]
+
+
+def _sum_nccl(grads):
+    """Sums the tensors of different GPUs with a NCCL reduction."""
+    from tensorflow.contrib import nccl
+    return nccl.reduce_sum(grads)
+
+
+_GRADIENT_REDUCTIONS = {"add_n": tf.add_n,
+                        "hierarchical": _sum_hierarchical,
+                        "nccl": _sum_nccl}
+
+
+def combine_gradients(tower_grads, reduction="add_n"):
     """Calculate the combined gradient for each shared variable across all towers.
 
      Note that this function provides a synchronization point across all towers.
@@ -198,16 +270,87 @@ def combine_gradients(tower_grads):
        tower_grads: List of lists of (gradient, variable) tuples. The outer list
          is over individual gradients. The inner list is over the gradient
          calculation for each tower.
+       reduction: How the dense gradients are summed: 'add_n', 'hierarchical'
+         (a tree of pairwise sums across the tower devices) or 'nccl' (a NCCL
+         reduction, only with GPU towers). The IndexedSlices are always
+         concatenated.
      Returns:
         List of pairs of (gradient, variable) where the gradient has been summed
         across all towers.
+
+     Raises:
+       ValueError: If the reduction is unknown.
     """
+    if reduction not in _GRADIENT_REDUCTIONS:
+        raise ValueError("Unknown gradient reduction '%s', expected one of %s." %
+                         (reduction, sorted(_GRADIENT_REDUCTIONS)))
     filtered_grads = [[x for x in grad_list if x[0] is not None] for grad_list in tower_grads]
     final_grads = []
     for i in xrange(len(filtered_grads[0])):
-        grads = [filtered_grads[t][i] for t in xrange(len(filtered_grads))]
-        grad = tf.stack([x[0] for x in grads], 0)
-        grad = tf.reduce_sum(grad, 0)
+        grads = [filtered_grads[t][i][0] for t in xrange(len(filtered_grads))]
+        if len(grads) == 1:
+            grad = grads[0]
+        elif all(isinstance(x, tf.IndexedSlices) for x in grads):
+            grad = _sum_indexed_slices(grads)
+        else:
+            grads = [tf.convert_to_tensor(x) for x in grads]
+            grad = _GRADIENT_REDUCTIONS[reduction](grads)
         final_grads.append((grad, filtered_grads[0][i][1],))
 
     return final_grads
+
+
+def _batch_gather(params, indices):
+    """Gathers the entries indices[i, j] of every row i of params."""
+    rows = tf.tile(tf.expand_dims(tf.range(tf.shape(indices)[0]), 1),
+                   [1, tf.shape(indices)[1]])
+    return tf.gather_nd(params, tf.stack([rows, indices], 2))
+
+
+def build_top_k_metrics(predictions, labels, top_k=20):
+    """Builds the graph computing the per-batch metrics and the top k
+    predictions of every video.
+
+    Fetching these tensors instead of the 'batch' x 'num_classes' predictions
+    and labels is enough for eval_util.EvaluationMetrics.accumulate_top_k and
+    eval_util.calculate_gap_top_k.
+
+    Args:
+    predictions: Tensor containing the outputs of the model.
+      Dimensions are 'batch' x 'num_classes'.
+    labels: Tensor containing the ground truth labels.
+      Dimensions are 'batch' x 'num_classes'.
+    top_k: How many predictions to keep per video.
+
+    Returns:
+    A dictionary of tensors: the scalar "hit_at_one" and "perr" of the batch,
+    the 'batch' x top_k "top_indices", "top_predictions" and "top_labels" sorted
+    by descending prediction, and "num_positives", the number of positives of
+    every class.
+    """
+    labels = tf.cast(labels, tf.float32)
+    num_classes = predictions.get_shape().as_list()[1]
+    top_predictions, top_indices = tf.nn.top_k(predictions,
+                                               min(top_k, num_classes))
+    top_labels = _batch_gather(labels, top_indices)
+
+    # The precision at equal recall rate looks at the num_labels[i] highest
+    # predictions of every video.
+    num_labels = tf.cast(tf.reduce_sum(labels, 1), tf.int32)
+    perr_k = tf.clip_by_value(tf.reduce_max(num_labels), 1, num_classes)
+    perr_predictions, perr_indices = tf.nn.top_k(predictions, perr_k)
+    in_top = tf.logical_and(tf.sequence_mask(num_labels, perr_k),
+                            perr_predictions > 0)
+    hits = tf.reduce_sum(
+        tf.where(in_top, _batch_gather(labels, perr_indices),
+                 tf.zeros_like(perr_predictions)), 1)
+    precision = tf.where(
+        num_labels > 0, hits / tf.cast(tf.maximum(num_labels, 1), tf.float32),
+        tf.zeros_like(hits))
+
+    return {"hit_at_one": tf.reduce_mean(top_labels[:, 0]),
+            "perr": tf.reduce_mean(precision),
+            "top_indices": top_indices,
+            "top_predictions": top_predictions,
+            "top_labels": top_labels,
+            "num_positives": tf.reduce_sum(labels, 0)}